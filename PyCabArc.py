@@ -3,7 +3,7 @@
 """
 PyCabArc.py
 
-This Python 2.7 module (and stand-alone mini app) shows how to use zlib module
+This Python 2.7 and 3 module (and stand-alone mini app) shows how to use zlib module
 to emulate "MS"-ZIP compression in a cabinet. It can span cabinet sets, too!
 
 
@@ -21,6 +21,32 @@ like MS spec formally requires (Cabarc 5.2 and the Windows shell, however, can
 extract a stream built with many Z_SYNC_FLUSH calls and a single Z_FINISH at
 folder's end).
 
+That is the default ("strict") block termination strategy: MSZIP (Cabinet, and
+the -m switch, i.e. -m mszip:6:sync) can also end blocks with:
+- "sync": a Z_SYNC_FLUSH plus a constant empty final block, the same bytes the
+  cloned compressor gives: it saves cloning the compressor at each block
+- "full": a Z_FULL_FLUSH plus the empty final block, so that blocks don't refer
+  to the previous ones (and the parallel compressor doesn't need to prime them);
+  it costs some ratio
+Every CFDATA ends with a final Deflate block, whatever the strategy.
+
+Measured with 32 KiB blocks (Python 2.7, zlib 1.2, one x86-64 core), on 16 MB
+of synthetic lorem ipsum text and on a mix of text and random binary files:
+
+  level strategy   text MB/s  ratio    mix MB/s  ratio
+  1     strict       102.0    0.2597     69.7    0.4357
+  1     sync         104.1    0.2596     88.0    0.4357
+  1     full         117.5    0.2615    102.8    0.4367
+  6     strict        19.6    0.1932     25.6    0.3819
+  6     sync          19.9    0.1932     25.8    0.3818
+  6     full          24.3    0.1983     30.0    0.3854
+  9     strict         1.9    0.1718      3.0    0.3673
+  9     sync           1.9    0.1717      3.0    0.3673
+  9     full           4.1    0.1877      5.9    0.3781
+
+"sync" gains where blocks compress fast (the copy costs the same at any level);
+"full" gains most at high levels, with ratios up to 9% worse.
+
 Since a raw compressed block MUST never exceed 32768+12 bytes, when such a block
 is found, we emit it uncompressed, requiring exactly 32775 bytes ('CK' + block
 type 01 + block length 0x8000 + 1 complement 0x7FFF + raw data).
@@ -38,7 +64,15 @@ NOTE THAT SOME OF THESE TOOLS *REQUIRE* CFDATA CHECKSUMS TO WORK PROPERLY!
 Current version supports having more folders, even with different compression type.
 Quantum compression is not supported.
 
-LZX is implemented with the MSCompression library, that actually doesn't work properly.
+LZX (windows of 2^15..2^21 bytes) is implemented by PyLZX: matches are found
+with hash chains, repeated offsets first, with a lazy step, and each 32 KiB frame
+is coded as a block with its own Huffman trees (verbatim or aligned offsets, or
+stored if it doesn't compress). Its match finder and bit writer are in the
+optional _lzx module (build it with _lzx.sh or _lzx.bat): so it compresses some
+MB/s, like MSZIP level 9 with a 32 KiB window and tighter with a bigger one.
+Without _lzx it runs in pure Python, well below 1 MB/s: then LZX is only good
+for small cabinets. UnLZX decompresses LZX in pure Python. The LZX and LZX2
+classes still drive Jeff's DLLs on Windows.
 
 
 MODULE USAGE
@@ -48,17 +82,40 @@ MODULE USAGE
 	cab = Cabinet('a.cab','w') # an optional 3rd argument sets max cabinet size
 	cab.AddHeader()
 	cab.AddFolder()
+	cab.route = 1 # optional: files that don't compress go to a stored folder
+	cab.cache = FolderCache('C:/TEMP/cabcache') # optional: reuses folders compressed before
+	cab.progress = ShowProgress # optional: called as (files, total files, bytes, total bytes)
+	cab.metrics = Metrics() # optional: times each stage, file and folder (see Report)
+	cab.folderworkers = 4 # optional: compresses up to 4 folders at a time
+	cab.autotune = 20 # optional: MSZIP levels picked to compress 20 MB/s (or budget = seconds)
 	cab.Add('cabarc.doc')
 	cab.AddWild('C:/Windows/INF/*.*')
+	cab.AddFolder(9) # a folder with its own MSZIP level
+	cab.AddWild('C:/Windows/Help/*.*')
 	cab.AddFolder(0) # specify 0 to store only
 	cab.AddWild('C:/My Documents/MP3/*.mp3')
 	cab.Flush()
+	print(cab.Report()) # time spent in each stage, file and folder (with a Metrics)
+	cab.Close()
+
+	cab = Cabinet('a.cab','r') # next cabinets in a set are opened, too
+	print(cab.namelist())
+	data = cab.open('cabarc.doc').read()
+	cab.extractall('C:/TEMP') # 4 folders at a time, with extractall('C:/TEMP', 4)
+	print(cab.testall()) # errors found verifying checksums and inflating folders
+	cab.BuildIndex() # to open() items quickly, even in huge folders
+	cab.SaveIndex() # a.cab.idx will be loaded when opening a.cab again
 	cab.Close()
 
 Mini app samples:
 
 	PyCabArc.py -P * a.cab /usr/python/lib/*.pyo
 	PyCabArc.py -r -m mszip:1 -d 1400000 -l "INF Cabinet #" infcab#.cab c:\windows\inf
+	PyCabArc.py -c -d 700000 infhalf#.cab infcab1.cab (splits the set again)
+	PyCabArc.py -c inf.cab infcab1.cab (merges the set)
+	PyCabArc.py -x infcab1.cab C:\TEMP\INF (extracts the set)
+	PyCabArc.py -t -j 8 *.cab (tests all cabinets, 8 folders at a time)
+	PyCabArc.py -v infcab1.cab (lists the set)
 
 
 HISTORY:
@@ -94,6 +151,91 @@ HISTORY:
                      implemented an LZX2 class with Jeff's CabLzxDll
 11.12.2013  v.0.33   works again with -m NONE
                      always marks last CFDATA Deflated sub-block as final
+16.10.2026  v0.34    parallel MS-ZIP: blocks compressed by a thread pool (-j switch),
+                     each one primed with the previous 32 KiB of its folder (a preset
+                     dictionary, with Python 3)
+                     pure Python checksum folds the whole block (and works on 64-bit
+                     Linux, too); optional NumPy and batch (CKSB) checksums;
+                     _checksum.c builds everywhere (_checksum.sh)
+                     reads and extracts cabinets (and sets) streaming MS-ZIP folders:
+                     namelist(), open(), extract(), extractall()
+                     CFDATA index (BuildIndex, SaveIndex/LoadIndex to a .idx sidecar)
+                     to seek into a folder without inflating it from the beginning
+                     single-pass writing: no more temporary files, CFDATA are written
+                     (once) into the cabinet after room reserved for the header; items
+                     and folders are queued and written by Flush
+                     input blocks are assembled in place (readinto a ring of 32 KiB
+                     buffers, no string concatenation nor recursion) and passed as
+                     buffers to compressor, checksum and output; exactly cbFile bytes
+                     are read from each file
+                     pipelined reading (Prefetcher thread), compression plus checksum
+                     and writing, with bounded queues (-q switch, depth and readahead)
+                     MSZIP block termination strategies: strict, sync and full
+                     fixed blocks exactly filling a cabinet unit split in an empty CFDATA
+                     store-vs-compress routing (route attribute, -a switch): files that
+                     don't deflate well at a quick trial go to an uncompressed folder
+                     folder planner (foldersize and folderfiles, -f switch): new folders
+                     start when the last one is full; none exceeds MAXFOLDER bytes
+                     Catalog replaces idict: items are hashed by a normalized (case
+                     insensitive) name, wildcards are only matched by namelist(pattern)
+                     AddTree and ScanTree: directories are listed by a thread pool (with
+                     scandir, if available) and each file is stat'ed only once
+                     incremental update (base attribute, -u switch): folders whose files
+                     didn't change are copied block by block, without recompression
+                     AddCabinet (-c switch) splits a set again or merges cabinets and sets,
+                     copying their CFDATA (only re-split and re-checksummed); a file is
+                     marked as continued only if it really ends past a cabinet unit
+                     dedup attribute (-e switch): a file with the contents of one queued
+                     before (hashed only if their sizes match) points to its data; such
+                     overlapping items aren't portable: cabextract and this module read
+                     them, libarchive (bsdtar) rejects the cabinet as invalid
+                     FolderCache (cache attribute, -k switch): the CFDATA of a folder are
+                     kept on disk by a digest of its files and compression, and copied
+                     when building again; least recently used ones go beyond a size
+                     bench.py: benchmarks on synthetic corpora (MSZIP levels, checksums,
+                     whole cabinets and sets, headers), with MB/s, ratio and peak RSS
+                     saved as JSON and compared with a previous run
+                     Metrics (metrics attribute, -M switch): time and bytes of each stage
+                     (read, compress, checksum, write, copy), per file (totals and max)
+                     and per folder timings, with hooks and a progress callback; Report()
+                     gives them as JSON or Prometheus text; off (NoMetrics) by default
+                     runs on Python 3, too: structures, compressors and IOStream work on
+                     bytes, bytearray and memoryview, with the same output of Python 2.7;
+                     item names are kept as bytes (text() decodes them); Close() stops
+                     the pipeline threads
+                     FolderPool (folderworkers attribute, -F switch): MSZIP folders are
+                     read and compressed whole on a thread pool, a few ahead of the one
+                     being written, then laid out (and split) like copied folders
+                     compressor registry (COMPRESSORS, NewCompressor): each folder type has
+                     its own compressor, so AddFolder(1..9) really sets the MSZIP level of
+                     a folder (AddFolder() takes the Cabinet's one); a continued folder
+                     keeps its level
+                     autotune and budget attributes (-A switch): the MSZIP level of each
+                     folder is picked by a trial on its first blocks, to compress at some
+                     MB/s or all the folders within some seconds
+                     PyLZX: a pure Python LZX compressor (windows 15..21, hash chains
+                     with lazy matching, verbatim, aligned or uncompressed blocks with
+                     canonical Huffman trees), replacing the Windows DLLs for -m LZX
+                     UnLZX: a pure Python LZX decompressor, so that -t and -x read LZX
+                     folders too
+                     _lzx.c: PyLZX's match finder and bit writer in C, optional (built
+                     with _lzx.sh or _lzx.bat) and giving the same blocks; PyLZX indexes
+                     all the positions, looks deeper with it and is lazy at every match
+                     extractall inflates folders in parallel (workers argument, -x switch)
+                     streaming them to files preallocated to cbFile, whose dates and
+                     attributes are restored; testall (-t switch) verifies CFDATA
+                     checksums and inflates all folders, writing nothing
+                     CFHEADER.Read takes header and folders in a single read, and the
+                     CFFILE table in another one, parsed with precompiled structs;
+                     names are hashed in the catalog at the first lookup; -v switch
+                     lists a cabinet (or set)
+                     CFFILE, CFFOLDER and CFDATA have __slots__ and precompiled structs;
+                     the IOStream queue is a deque; folder size is summed incrementally
+                     (flushing is no more quadratic in the files); items of a written
+                     unit are released; a writing Cabinet counts items instead of
+                     cataloging them; ScanTree yields the files, keeping the stats of
+                     each directory in arrays; queued files are packed in a string
+                     each, and written ones in their header record
 
 
 TO DO & WISHES:
@@ -101,12 +243,7 @@ TO DO & WISHES:
 - note: using Python ctypes and logging breaks compatibility with older Pythons
 - integrate FileSetStream in I/O?
 - add references to container in each object (to simplify things)?
-- bind compressor object to its folder (so each folder gets its own compression
-  method and/or level? is this permitted?
-- add a simple extractor?
-- split, merge and update cabinets (all require folder recompression ;-)
 - better error checking
-- limit folders by size?
 - update cmd line manager with optparse/argparse?
 - find infos about 3DES encrypted CABs? Windows Phone?
 
@@ -114,76 +251,197 @@ WARNING: according to VS2010 documentation, a splitted CAB couldn't contain more
 15 files across 2 segments... Did such limit exist with those old Win95 MSDMF CABs???
 """
 
-VERSION = '0.33'
+from __future__ import print_function
+
+VERSION = '0.34'
 
-COPYRIGHT = '''Copyright (C)2004-2013, by maxpat78. GNU GPL v2 applies.
+COPYRIGHT = '''Copyright (C)2004-2026, by maxpat78. GNU GPL v2 applies.
 This free software creates MS Cabinets WITH ABSOLUTELY NO WARRANTY!'''
 
 DEBUG = 0
 
+MAXFOLDER = 0x7FFF8000 # max uncompressed bytes in a folder (65535 CFDATA)
+
+import array
+import binascii
+import bisect
+import collections
+import copy
 import fnmatch
 import getopt
 import glob
+import hashlib
+import heapq
+import io
+import json
 import logging
 import os
 import random
+import re
+import shutil
+import stat
 import struct
 import sys
 import tempfile
+import threading
 import time
 import zlib
 from ctypes import *
 from datetime import datetime as dt
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
+
+try:
+	import Queue as queue
+except ImportError: # Python 3
+	import queue
+
+if sys.version_info[0] > 2:
+	# Structures and blocks are bytes (or bytearray and memoryview) everywhere
+	xrange = range
+	long = int
+	def buffer(o, offset=0, size=-1):
+		return memoryview(o)[offset:size < 0 and len(o) or offset+size]
+	fsbytes, fstext = os.fsencode, os.fsdecode # cabinet names in headers
+else:
+	fsbytes = fstext = lambda s: s
+
+ZDICT = sys.version_info >= (3, 3) # zlib compressors take a preset dictionary
+FROM_BYTES = hasattr(int, 'from_bytes') # Python 3 reads little endian integers
 
 def Checksum(s, seed=0):
-	"Implements MS CAB xoring checksum in Python (~33% slower than C version)"
-	csum = seed
-	loops = len(s) / 8
-	i = 0
-	while loops > 0:
-		csum ^= cast(s[i:i+8], POINTER(c_ulonglong)).contents.value
-		i += 8
-		loops -= 1
-	rem = len(s) % 8
-	if rem:
-		if rem >= 4:
-			csum ^= cast(s[i:i+4], POINTER(c_ulong)).contents.value
-			i += 4
-		j = rem % 4
-		while j:
-			j -= 1
-			csum ^= (cast(s[i], POINTER(c_ubyte)).contents.value << j*8)
-			i += 1
-	return abs((csum & 0xFFFFFFFF) ^ (csum >> 32))
+	"Implements MS CAB xoring checksum in Python, folding the block as a whole"
+	n = len(s) >> 2 # 32-bit words
+	csum = 0
+	if n:
+		# The words, taken as one integer, are XORed together by halving it at
+		# each step: a big endian one (Python 2) is then byte swapped
+		if FROM_BYTES:
+			csum = int.from_bytes(s[:n << 2], 'little')
+		else:
+			csum = long(binascii.hexlify(s[:n << 2]), 16)
+		while n > 1:
+			k = n >> 1
+			csum = (csum >> (k << 5)) ^ (csum & ((1 << (k << 5)) - 1))
+			n -= k
+		if not FROM_BYTES:
+			csum = struct.unpack('<L', struct.pack('>L', csum))[0]
+	t = 0 # trailing 1..3 bytes are taken in reverse order
+	for c in bytearray(s[len(s) & ~3:]):
+		t = t << 8 | c
+	return (csum ^ t ^ seed) & 0xFFFFFFFF
+
+def NumPyChecksum(s, seed=0):
+	"Implements MS CAB xoring checksum with a single NumPy reduction"
+	n = len(s) >> 2
+	csum = 0
+	if n:
+		csum = int(numpy.bitwise_xor.reduce(numpy.frombuffer(s, '<u4', n)))
+	t = 0
+	for c in bytearray(s[n << 2:]):
+		t = t << 8 | c
+	return (csum ^ t ^ seed) & 0xFFFFFFFF
+
+def Checksums(blocks, seed=0):
+	"Returns the checksums of a list of blocks"
+	return [CKS(s, seed) for s in blocks]
+
+def NumPyChecksums(blocks, seed=0):
+	"Returns the checksums of a list of blocks, with a single NumPy reduction"
+	words = [len(s) >> 2 for s in blocks]
+	a = numpy.frombuffer(b''.join([bytes(s[:w << 2]) for s, w in zip(blocks, words)]), '<u4')
+	L = [0] * len(blocks)
+	starts, i = [], 0
+	for w in words:
+		starts += [i]
+		i += w
+	# reduceat can't handle empty slices, so only non empty blocks are passed
+	full = [i for i in range(len(blocks)) if words[i]]
+	if full:
+		R = numpy.bitwise_xor.reduceat(a, [starts[i] for i in full]).tolist()
+		for i, csum in zip(full, R):
+			L[i] = csum
+	for i, s in enumerate(blocks):
+		t = 0
+		for c in bytearray(s[words[i] << 2:]):
+			t = t << 8 | c
+		L[i] = (L[i] ^ t ^ seed) & 0xFFFFFFFF
+	return L
 
 try:
-	# Optional Python module... what a difficult thing to implement!!!
+	# Optional Python module (build it with _checksum.bat or _checksum.sh)
 	import _checksum
 	CKS = _checksum.checksum
-except:
-	CKS = Checksum
+	CKSB = getattr(_checksum, 'checksums', Checksums)
+except ImportError:
+	try:
+		import numpy
+		CKS, CKSB = NumPyChecksum, NumPyChecksums
+	except ImportError:
+		CKS, CKSB = Checksum, Checksums
 
-class idict(dict):
-	"Dictionary with case-insensitive (or wildcarded) keys"
-	def __contains__ (p, item):
-		if dict.__contains__(p,item) or fnmatch.filter(dict.keys(p),item):
-			return 1
-		return 0
+try:
+	# Optional Python module (build it with _lzx.bat or _lzx.sh): PyLZX in C
+	import _lzx
+except ImportError:
+	_lzx = None
+
+try:
+	from os import scandir # Python 3.5+
+except ImportError:
+	try:
+		from scandir import scandir # optional Python 2 module
+	except ImportError:
+		scandir = None
+
+class CabArcException(Exception): pass
+
+class Catalog(dict):
+	"Dictionary of items with case-insensitive keys (and slashes as back slashes)"
+	def __init__(p):
+		dict.__init__(p)
+		p.nkeys = {} # normalized key -> key
+		p._sorted = None # normalized keys, sorted for wildcard queries
+
+	def _norm(p, key): return key.replace('/','\\').lower()
+
+	def __contains__ (p, key):
+		return dict.__contains__(p,key) or p._norm(key) in p.nkeys
 
 	def __getitem__ (p, key):
-		if not dict.has_key(p,key):
-			try:
-				key = fnmatch.filter(dict.keys(p),key)[0]
-			except:
-				pass
+		if not dict.__contains__(p,key):
+			key = p.nkeys.get(p._norm(key), key)
 		return dict.__getitem__(p,key)
 
 	def __setitem__ (p, key, value):
-		try:
-			key = fnmatch.filter(dict.keys(p),key)[0]
-		except:
-			pass
-		return dict.__setitem__(p,key,value)
+		k = p._norm(key)
+		if k not in p.nkeys:
+			p.nkeys[k] = key
+			p._sorted = None
+		return dict.__setitem__(p,p.nkeys[k],value)
+
+	def __delitem__ (p, key):
+		key = p.nkeys.pop(p._norm(key), key)
+		p._sorted = None
+		return dict.__delitem__(p,key)
+
+	def match(p, pattern):
+		"Returns the keys matching a wildcard pattern, in order"
+		pattern = p._norm(pattern)
+		i = len(pattern)
+		for c in '*?[':
+			if c in pattern: i = min(i, pattern.index(c))
+		prefix = pattern[:i] # the keys to test share it
+		if p._sorted is None:
+			p._sorted = sorted(p.nkeys)
+		rx = re.compile(fnmatch.translate(pattern))
+		L = []
+		for k in p._sorted[bisect.bisect_left(p._sorted, prefix):]:
+			if not k.startswith(prefix): break
+			if rx.match(k):
+				L += [p.nkeys[k]]
+		return L
 
 class LZX:
 # Emulates an LZX compressor by directly accessing Jeff's MSCompression.dll
@@ -192,7 +450,8 @@ class LZX:
 		p.state = cdll.MSCompression.lzx_cab_compress_start(level)
 		
 	def compress(p, s):
-		if not s: return ''
+		if not s: return b''
+		s = bytes(s)
 		SIZE_T=32768+6144
 		dst = create_string_buffer(SIZE_T)
 		size = cdll.MSCompression.lzx_cab_compress_block(s, len(s), dst, SIZE_T, p.state)
@@ -202,7 +461,7 @@ class LZX:
 	def flush(p):
 		cdll.MSCompression.lzx_cab_compress_end(p.state)
 		p.state = cdll.MSCompression.lzx_cab_compress_start(p.level)
-		return ''
+		return b''
 
 class LZX2:
 # Emulates an LZX compressor by directly accessing Jeff's CabLzxDll.dll
@@ -211,7 +470,8 @@ class LZX2:
 		cdll.CabLzxDll.fci_init()
 		
 	def compress(p, s):
-		if not s: return ''
+		if not s: return b''
+		s = bytes(s)
 		SIZE_T=32768+6144
 		dst = create_string_buffer(SIZE_T)
 		size = cdll.CabLzxDll.fci_lzx_cab_compress(s, len(s), dst, SIZE_T, p.level, 1)
@@ -220,37 +480,696 @@ class LZX2:
 		
 	def flush(p):
 		cdll.CabLzxDll.fci_init()
-		return ''
+		return b''
+
+def HuffmanLengths(freqs, limit):
+	"Returns the code lengths of a Huffman code for symbol frequencies, none longer than limit"
+	L = [0] * len(freqs)
+	syms = [i for i, f in enumerate(freqs) if f]
+	if len(syms) == 1:
+		# a tree needs two codes: a single symbol gets a dummy sibling (in range)
+		syms += [syms[0] ^ 1 < len(freqs) and syms[0] ^ 1 or syms[0] - 1]
+	if len(syms) == 2:
+		for i in syms:
+			L[i] = 1
+	if len(syms) < 3:
+		return L
+	while 1:
+		heap = [(freqs[i], i, [i]) for i in syms]
+		heapq.heapify(heap)
+		for i in syms:
+			L[i] = 0
+		while len(heap) > 1:
+			a = heapq.heappop(heap)
+			b = heapq.heappop(heap)
+			for i in a[2] + b[2]:
+				L[i] += 1
+			heapq.heappush(heap, (a[0] + b[0], a[1], a[2] + b[2]))
+		if max(L) <= limit:
+			return L
+		freqs = [f and max(1, f >> 1) for f in freqs] # flatter, so shorter
+
+def HuffmanCodes(lengths):
+	"Returns the canonical codes for code lengths, as strings of bits"
+	codes = [''] * len(lengths)
+	code = 0
+	for n in range(1, max(lengths) + 1):
+		for i, l in enumerate(lengths):
+			if l == n:
+				codes[i] = format(code, '0%db' % n)
+				code += 1
+		code <<= 1
+	return codes
+
+def HuffmanTable(lengths):
+	"Returns the decoding table of a canonical code: (symbol << 5 | length) by the next 16 bits (0 if none)"
+	T = [0] * 65536
+	code, last = 0, 0
+	for l, i in sorted([(l, i) for i, l in enumerate(lengths) if l]):
+		code <<= l - last
+		last = l
+		n = 1 << (16 - l)
+		if (code + 1) * n > 65536:
+			raise CabArcException('Bad Huffman code lengths!')
+		T[code*n:(code+1)*n] = [i << 5 | l] * n
+		code += 1
+	return T
+
+# LZX position slots by window size, footer bits and first formatted offset of each slot
+LZX_SLOTS = {15: 30, 16: 32, 17: 34, 18: 36, 19: 38, 20: 42, 21: 50}
+LZX_EXTRA = [0, 0] + [min(i >> 1, 17) for i in range(50)]
+LZX_BASE = [sum([1 << x for x in LZX_EXTRA[:i]]) for i in range(51)]
+
+class PyLZX:
+# LZX compressor with a window of 2^15..2^21 bytes: matches are found with hash
+# chains (of the positions of each 4 bytes sequence) and each 32 KiB frame is a
+# block with its own Huffman trees, verbatim or aligned (or an uncompressed one,
+# if it costs less). The optional _lzx module finds matches and writes the bits
+# (giving the same blocks), else it's pure Python: slow, and less deep by default
+	def __init__(p, level=15, depth=None):
+		if level not in LZX_SLOTS:
+			raise CabArcException('LZX window MUST be in the range 15...21!')
+		p.level = level
+		p.size = 1 << level
+		p.depth = depth or (_lzx and 256 or 64) # matches tried at each position
+		p.nmain = 256 + 8 * LZX_SLOTS[level]
+		p.prev = array.array('i', [-1]) * p.size # previous offset with the same hash
+		p.flush()
+
+	def flush(p):
+		"Ends the folder's stream: the next block starts a new one"
+		p.data = b'' # last window of the stream
+		p.base = 0 # stream offset of data[0]
+		p.head = array.array('i', [-1]) * 65536 # last stream offset of each hash
+		p.R = (1, 1, 1) # repeated offsets
+		p.mlens = [0] * p.nmain # previous trees, which new ones are coded against
+		p.llens = [0] * 249
+		p.first = 1 # the stream header is still to write
+		return b''
+
+	def _hashes(p, W, i, end):
+		"Returns the hashes of the 4 bytes at each position of W[i:end-3]"
+		H = [0] * (end - i - 3)
+		if not H: return H
+		for k in range(4):
+			n = (end - i - k) >> 2
+			V = struct.unpack('<%dL' % n, W[i+k:i+k+4*n])
+			H[k::4] = [(v * 2654435761 >> 16) & 0xFFFF for v in V][:len(H[k::4])]
+		return H
+
+	def _parse(p, W, i, end):
+		"Returns the tokens of W[i:end]: literal runs (bytes) and matches (formatted offset, length)"
+		if _lzx:
+			T, p.R = _lzx.parse(W, i, end, p.base, p.R, p.head, p.prev, p.depth)
+			return T
+		head, prev, mask, base, depth = p.head, p.prev, p.size - 1, p.base, p.depth
+		maxoff = p.size - 3
+		R0, R1, R2 = p.R
+		H = p._hashes(W, i, end)
+		start, last = i, end - 3
+
+		def longest(i, cand, best, d):
+			"Walks the chain of positions with the same hash, nearest first"
+			n = end - i
+			if n > 257: n = 257
+			off = 0
+			if best >= n: return best, off
+			while cand >= 0 and d:
+				j = cand - base
+				if j < 0 or i - j > maxoff: break
+				if W[j+best] == W[i+best] and W[j:j+4] == W[i:i+4]:
+					l = 4
+					while l + 8 <= n and W[j+l:j+l+8] == W[i+l:i+l+8]: l += 8
+					while l < n and W[j+l] == W[i+l]: l += 1
+					if l > best:
+						best, off = l, i - j
+						if l >= n: break
+				x = prev[cand & mask]
+				if x >= cand: break # overwritten by a newer position
+				cand = x
+				d -= 1
+			return best, off
+
+		T = []
+		lit = miss = i
+		while i < last:
+			pos = base + i
+			h = H[i - start]
+			cand = head[h]
+			head[h] = pos
+			prev[pos & mask] = cand
+			n = end - i
+			if n > 257: n = 257
+			# repeated offsets cost no footer: they are tried first
+			rlen, rk = 0, 0
+			for k, r in ((0, R0), (1, R1), (2, R2)):
+				j = i - r
+				if j >= 0 and W[j] == W[i] and W[j+1] == W[i+1]:
+					l = 2
+					while l + 8 <= n and W[j+l:j+l+8] == W[i+l:i+l+8]: l += 8
+					while l < n and W[j+l] == W[i+l]: l += 1
+					if l > rlen:
+						rlen, rk = l, k
+			best, off = longest(i, cand, 3, depth)
+			if rlen >= 2 and (not off or rlen + 1 >= best):
+				best, f = rlen, rk
+				if rk == 1: R0, R1 = R1, R0
+				elif rk == 2: R0, R2 = R2, R0
+			elif off:
+				# lazy evaluation: a literal, if a longer match starts next
+				if i + 1 < last and longest(i + 1, head[H[i + 1 - start]], best + 1, depth)[1]:
+					i += 1
+					continue
+				f = off + 2
+				R0, R1, R2 = off, R0, R1
+			else:
+				# where nothing matched for a while, positions are skipped
+				i += 1 + ((i - miss) >> 7)
+				continue
+			if lit < i:
+				T += [W[lit:i]]
+			T += [(f, best)]
+			for k in range(i + 1, min(i + best, last)):
+				h = H[k - start]
+				prev[(base + k) & mask] = head[h]
+				head[h] = base + k
+			i += best
+			lit = miss = i
+		if lit < end:
+			T += [W[lit:end]]
+		p.R = (R0, R1, R2)
+		return T
+
+	def _trees(p, B, old, new):
+		"Writes code lengths, coded against the previous ones with a pretree"
+		S = [] # (pretree symbol, bits following it)
+		i, n = 0, len(new)
+		while i < n:
+			x, run = new[i], 1
+			while i + run < n and new[i+run] == x: run += 1
+			if not x and run >= 20:
+				run = min(run, 51)
+				S += [(18, format(run - 20, '05b'))]
+			elif not x and run >= 4:
+				S += [(17, format(run - 4, '04b'))]
+			elif run >= 4:
+				run = min(run, 5)
+				S += [(19, format(run - 4, '01b')), ((old[i] - x) % 17, '')]
+			else:
+				run = 1
+				S += [((old[i] - x) % 17, '')]
+			i += run
+		freqs = [0] * 20
+		for x, s in S:
+			freqs[x] += 1
+		lens = HuffmanLengths(freqs, 15)
+		codes = HuffmanCodes(lens)
+		B += [format(x, '04b') for x in lens]
+		B += [codes[x] + s for x, s in S]
+
+	def _counts(p, T):
+		"Returns the frequencies of main tree, length tree and aligned offset symbols in the tokens"
+		if _lzx:
+			return _lzx.counts(T, p.nmain)
+		EXTRA, BASE = LZX_EXTRA, LZX_BASE
+		fm, fl, fa = [0] * p.nmain, [0] * 249, [0] * 8
+		for t in T:
+			if type(t) is tuple:
+				f, l = t
+				slot = bisect.bisect_right(BASE, f) - 1
+				x = min(l - 2, 7)
+				fm[256 + (slot << 3) + x] += 1
+				if x == 7:
+					fl[l - 9] += 1
+				if EXTRA[slot] >= 3:
+					fa[(f - BASE[slot]) & 7] += 1
+			else:
+				for c in bytearray(t):
+					fm[c] += 1
+		return fm, fl, fa
+
+	def _write(p, bits, T, mlens, llens, alens=None):
+		"Packs a string of bits (header and trees) and the tokens, coded with the trees (aligned offsets, if alens)"
+		if _lzx:
+			return _lzx.write(bits, T, mlens, llens, alens)
+		EXTRA, BASE = LZX_EXTRA, LZX_BASE
+		MS, LS = HuffmanCodes(mlens), HuffmanCodes(llens)
+		AS = alens and HuffmanCodes(alens)
+		B = [bits]
+		for t in T:
+			if type(t) is tuple:
+				f, l = t
+				slot = bisect.bisect_right(BASE, f) - 1
+				x = min(l - 2, 7)
+				B += [MS[256 + (slot << 3) + x]]
+				if x == 7:
+					B += [LS[l - 9]]
+				x, footer = EXTRA[slot], f - BASE[slot]
+				if AS and x >= 3:
+					if x > 3:
+						B += [format(footer >> 3, '0%db' % (x - 3))]
+					B += [AS[footer & 7]]
+				elif x:
+					B += [format(footer, '0%db' % x)]
+			else:
+				B += [MS[c] for c in bytearray(t)]
+		return p._pack(''.join(B))
+
+	def compress(p, s):
+		"Compresses a 32 KiB frame (the last one can be smaller) as an LZX block"
+		if not s: return b''
+		s = bytes(s)
+		W = p.data + s
+		start = len(p.data)
+		R = p.R
+		T = p._parse(W, start, len(W))
+		fm, fl, fa = p._counts(T)
+		mlens = HuffmanLengths(fm, 16)
+		llens = HuffmanLengths(fl, 16)
+		alens = None
+		if sum(fa):
+			alens = HuffmanLengths(fa, 7)
+			if sum([a * b for a, b in zip(fa, alens)]) + 24 >= 3 * sum(fa):
+				alens = None # aligned offsets don't pay for their tree
+		B = p.first and ['0'] or [] # no E8 translation
+		B += [alens and '010' or '001', format(len(s), '024b')]
+		if alens:
+			B += [format(x, '03b') for x in alens]
+		p._trees(B, p.mlens[:256], mlens[:256])
+		p._trees(B, p.mlens[256:], mlens[256:])
+		p._trees(B, p.llens, llens)
+		buf = p._write(''.join(B), T, mlens, llens, alens)
+		if len(buf) > len(s) + 20:
+			# an uncompressed block: trees stay the same, repeated offsets too
+			bits = p.first and '0' or ''
+			bits += '011' + format(len(s), '024b')
+			bits += '0' * (16 - len(bits) % 16)
+			buf = p._pack(bits) + struct.pack('<3L', *R) + s + b'\x00' * (len(s) & 1)
+			p.R = R
+		else:
+			p.mlens, p.llens = mlens, llens
+		p.first = 0
+		p.data = W[-p.size:]
+		p.base += len(W) - len(p.data)
+		return buf
+
+	def _pack(p, bits):
+		"Packs a string of bits in 16-bit little endian words, padding the last one"
+		bits += '0' * (-len(bits) % 16)
+		buf = bytearray(binascii.unhexlify('%0*x' % (len(bits) >> 2, int(bits, 2))))
+		buf[0::2], buf[1::2] = buf[1::2], buf[0::2]
+		return bytes(buf)
 
 class MSZIP:
 # Emulates (more efficiently) a "MS"-ZIP compressor using ZLIB
-	def __init__(p, level=6, mem=8):
+# Blocks end according to strategy (see the module's doc):
+#  strict  Z_SYNC_FLUSH plus a Z_FINISH from a copy of the compressor
+#  sync    Z_SYNC_FLUSH plus a constant empty final block (the same bytes)
+#  full    Z_FULL_FLUSH plus the empty final block: blocks don't refer to the
+#          previous ones
+	STRATEGIES = ('strict', 'sync', 'full')
+
+	def __init__(p, level=6, mem=8, strategy='strict'):
+		if strategy not in MSZIP.STRATEGIES:
+			raise CabArcException('Unknown MSZIP strategy %s!' % strategy)
 		p.level = level
 		p.mem = mem
+		p.strategy = strategy
+		p.mode = {'full': zlib.Z_FULL_FLUSH}.get(strategy, zlib.Z_SYNC_FLUSH)
 		# level=1..9, method=8 (DEFLATE), window=2^15,raw(-),
 		# mem=6, data type=0 (unknown)
 		p.obj = zlib.compressobj(level, 8, -15, mem, 0)
 		
 	def compress(p, s):
-		"Compresses a string, and eventually discards superflous bytes"
-		buf = p.obj.compress(s)
-		buf = 'CK' + buf + p.obj.flush(zlib.Z_SYNC_FLUSH) + p.obj.copy().flush(zlib.Z_FINISH)
+		"Compresses a string (or buffer), and eventually discards superflous bytes"
+		buf = b'CK' + p.obj.compress(s) + p.obj.flush(p.mode)
+		if p.strategy == 'strict':
+			buf += p.obj.copy().flush(zlib.Z_FINISH)
+		else:
+			buf += b'\x03\x00' # an empty final block (fixed Huffman codes)
 		if len(buf) > 32780:
 			logging.debug("Got %d bytes compressed: emitting uncompressed block", len(buf))
 			# CK + 01 + 0x8000 + 0x7FFF + 32KiB raw data
-			buf = '\x43\x4B\x01\x00\x80\xFF\x7F' + s
+			buf = b'\x43\x4B\x01\x00\x80\xFF\x7F' + bytes(s)
 		return buf
 		
 	def flush(p):
 		"Flushes last folder, and creates a new compressor for the next one"
 		p.obj = zlib.compressobj(p.level, 8, -15, p.mem, 0)
-		return ''
+		return b''
+
+class ParallelMSZIP(MSZIP):
+# Compresses the 32 KiB blocks of a folder on a pool of threads (zlib releases
+# the GIL): since a CFDATA may only refer to the previous 32 KiB of history, each
+# block gets its own ZSTREAM, with the uncompressed block before it as a preset
+# dictionary (but with the full strategy).
+	def __init__(p, level=6, mem=8, workers=0, strategy='strict'):
+		MSZIP.__init__(p, level, mem, strategy)
+		p.workers = workers or cpu_count()
+		p.pool = ThreadPool(p.workers)
+		p.hist = b'' # last uncompressed 32 KiB of the current folder
+
+	def _block(p, job):
+		"Compresses a block with a new compressor primed with its history"
+		s, hist = job
+		if not hist or p.strategy == 'full':
+			obj = zlib.compressobj(p.level, 8, -15, p.mem, 0)
+		elif ZDICT:
+			obj = zlib.compressobj(p.level, 8, -15, p.mem, 0, hist)
+		else:
+			# Python 2 has no zdict: the primer's output is discarded (after a
+			# Z_SYNC_FLUSH it is byte aligned, so the block starts cleanly but
+			# can match into hist), doubling the work
+			obj = zlib.compressobj(p.level, 8, -15, p.mem, 0)
+			obj.compress(hist)
+			obj.flush(zlib.Z_SYNC_FLUSH)
+		buf = b'CK' + obj.compress(s) + obj.flush(zlib.Z_SYNC_FLUSH)
+		if p.strategy == 'strict':
+			buf += obj.flush(zlib.Z_FINISH)
+		else:
+			buf += b'\x03\x00'
+		if len(buf) > 32780:
+			logging.debug("Got %d bytes compressed: emitting uncompressed block", len(buf))
+			buf = b'\x43\x4B\x01\x00\x80\xFF\x7F' + bytes(s)
+		return buf
+
+	def compress(p, s):
+		return p.map([s])[0]
+
+	def jobs(p, blocks):
+		"Pairs consecutive blocks of the same folder with their histories"
+		jobs = []
+		for s in blocks:
+			jobs += [(s, p.hist)]
+			if len(s) < 32768:
+				p.hist = (bytes(p.hist) + bytes(s))[-32768:]
+			else: # IOStream doesn't reuse a block's buffer before the next batch
+				p.hist = s
+		return jobs
+
+	def map(p, blocks):
+		"Compresses a list of consecutive blocks of the same folder, in order"
+		return p.pool.map(p._block, p.jobs(blocks))
+
+	def flush(p):
+		p.hist = b''
+		return b''
+
+class UnMSZIP:
+# Decompresses the CFDATA blocks of a "MS"-ZIP folder, one at a time
+	def __init__(p):
+		p.hist = b'' # last uncompressed 32 KiB of the folder
+
+	def decompress(p, s, size=32768):
+		"Decompresses a CFDATA (a Deflate block knows its own size)"
+		if s[:2] != b'CK':
+			raise CabArcException('Bad MSZIP block signature!')
+		obj = zlib.decompressobj(-15)
+		if p.hist:
+			# a stored (not final) Deflate block loads the history in the window
+			obj.decompress(b'\x00' + struct.pack('<2H', len(p.hist), len(p.hist) ^ 0xFFFF) + p.hist)
+		s = obj.decompress(s[2:]) + obj.flush()
+		p.hist = (p.hist + s)[-32768:]
+		return s
+
+	def flush(p):
+		p.hist = b''
+		return b''
+
+class UnLZX:
+# Decompresses the CFDATA blocks of an LZX folder, one at a time: each one holds a
+# frame of the stream (32 KiB, the last one can be smaller), whose bits are realigned
+# to 16 at its end, but a block (and even a match) can run into the next frame
+	def __init__(p, level=15):
+		if level not in LZX_SLOTS:
+			raise CabArcException('LZX window MUST be in the range 15...21!')
+		p.size = 1 << level
+		p.nmain = 256 + 8 * LZX_SLOTS[level]
+		p.flush()
+
+	def flush(p):
+		p.win = bytearray() # last window of the stream, and what follows
+		p.base = 0 # stream offset of win[0]
+		p.frame = 0 # stream offset of the next frame
+		p.R = [1, 1, 1] # repeated offsets
+		p.mlens = [0] * p.nmain # previous trees, which new ones are coded against
+		p.llens = [0] * 249
+		p.type = p.left = p.length = 0 # current block: its type, bytes left and length
+		p.first = 1 # the stream header is still to read
+		p.e8 = 0 # file size of the E8 (x86 CALL) translation, if any
+		p.e8on = 0 # set by the first block which could hold E8 bytes
+		p.rest = b'' # input not consumed by the last frame
+		return b''
+
+	def _bits(p, n):
+		"Reads n (up to 17) bits"
+		while p.bn < n:
+			p.bb = p.bb << 16 | p.W[p.wi]
+			p.wi += 1
+			p.bn += 16
+		p.bn -= n
+		x = p.bb >> p.bn
+		p.bb &= (1 << p.bn) - 1
+		return x
+
+	def _symbol(p, T):
+		"Reads a symbol of a Huffman code, by its decoding table"
+		while p.bn < 16:
+			p.bb = p.bb << 16 | p.W[p.wi]
+			p.wi += 1
+			p.bn += 16
+		x = T[p.bb >> (p.bn - 16)]
+		if not x:
+			raise CabArcException('Bad LZX Huffman code!')
+		p.bn -= x & 31
+		p.bb &= (1 << p.bn) - 1
+		return x >> 5
+
+	def _lens(p, L, a, b):
+		"Reads the code lengths L[a:b], coded against the previous ones with a pretree"
+		T = HuffmanTable([p._bits(4) for i in range(20)])
+		while a < b:
+			x = p._symbol(T)
+			if x == 17:
+				run, x = p._bits(4) + 4, 0
+			elif x == 18:
+				run, x = p._bits(5) + 20, 0
+			elif x == 19:
+				run = p._bits(1) + 4
+				x = (L[a] - p._symbol(T)) % 17
+			else:
+				run, x = 1, (L[a] - x) % 17
+			run = min(run, b - a)
+			L[a:a+run] = [x] * run
+			a += run
+
+	def _block(p, data):
+		"Reads the header of the next block (and its trees)"
+		if p.type == 3:
+			p.wi, p.bb, p.bn = p.bp >> 1, 0, 0 # bits follow the uncompressed bytes
+		if p.first:
+			p.first = 0
+			if p._bits(1):
+				p.e8 = p._bits(16) << 16 | p._bits(16)
+		p.type = p._bits(3)
+		p.left = p.length = p._bits(16) << 8 | p._bits(8)
+		if p.type == 2:
+			p.atab = HuffmanTable([p._bits(3) for i in range(8)])
+		if p.type in (1, 2):
+			p._lens(p.mlens, 0, 256)
+			p._lens(p.mlens, 256, p.nmain)
+			p.mtab = HuffmanTable(p.mlens)
+			p._lens(p.llens, 0, 249)
+			p.ltab = HuffmanTable(p.llens)
+			if p.mlens[0xE8]:
+				p.e8on = 1
+		elif p.type == 3:
+			p.e8on = 1
+			if not p.bn:
+				p.wi += 1 # 1..16 bits pad to the 16-bit word, then bytes follow
+			p.bp = 2 * p.wi
+			if p.bp + 12 > len(data):
+				raise CabArcException('Bad LZX uncompressed block!')
+			p.R = list(struct.unpack('<3L', data[p.bp:p.bp+12]))
+			p.bp += 12
+		else:
+			raise CabArcException('Bad LZX block type %d!' % p.type)
+
+	def _copy(p, data, n):
+		"Copies n bytes of an uncompressed block"
+		s = data[p.bp:p.bp+n]
+		if len(s) < n:
+			raise CabArcException('Bad LZX uncompressed block!')
+		p.win += s
+		p.bp += n
+		p.left -= n
+		if not p.left and p.length & 1:
+			p.bp += 1 # a padding byte
+
+	def _decode(p, n):
+		"Decodes the symbols of a verbatim or aligned block, till n bytes or more are output"
+		W, wi, bb, bn = p.W, p.wi, p.bb, p.bn
+		win = p.win
+		MT, LT = p.mtab, p.ltab
+		AT = p.type == 2 and p.atab
+		EXTRA, BASE = LZX_EXTRA, LZX_BASE
+		R0, R1, R2 = p.R
+		end = len(win) + n
+		while len(win) < end:
+			if bn < 16:
+				bb = bb << 16 | W[wi]
+				wi += 1
+				bn += 16
+			x = MT[bb >> (bn - 16)]
+			if not x:
+				raise CabArcException('Bad LZX Huffman code!')
+			bn -= x & 31
+			bb &= (1 << bn) - 1
+			m = x >> 5
+			if m < 256:
+				win.append(m)
+				continue
+			m -= 256
+			l = m & 7
+			if l == 7:
+				if bn < 16:
+					bb = bb << 16 | W[wi]
+					wi += 1
+					bn += 16
+				x = LT[bb >> (bn - 16)]
+				if not x:
+					raise CabArcException('Bad LZX Huffman code!')
+				bn -= x & 31
+				bb &= (1 << bn) - 1
+				l += x >> 5
+			l += 2
+			slot = m >> 3
+			if slot == 0:
+				off = R0
+			elif slot == 1:
+				off, R1, R0 = R1, R0, R1
+			elif slot == 2:
+				off, R2, R0 = R2, R0, R2
+			else:
+				x = EXTRA[slot]
+				off = BASE[slot] - 2
+				if AT and x >= 3:
+					if x > 3:
+						while bn < x - 3:
+							bb = bb << 16 | W[wi]
+							wi += 1
+							bn += 16
+						bn -= x - 3
+						off += (bb >> bn) << 3
+						bb &= (1 << bn) - 1
+					if bn < 16:
+						bb = bb << 16 | W[wi]
+						wi += 1
+						bn += 16
+					x = AT[bb >> (bn - 16)]
+					if not x:
+						raise CabArcException('Bad LZX Huffman code!')
+					bn -= x & 31
+					bb &= (1 << bn) - 1
+					off += x >> 5
+				elif x:
+					while bn < x:
+						bb = bb << 16 | W[wi]
+						wi += 1
+						bn += 16
+					bn -= x
+					off += bb >> bn
+					bb &= (1 << bn) - 1
+				R0, R1, R2 = off, R0, R1
+			i = len(win) - off
+			if i < 0 or off > p.size:
+				raise CabArcException('Bad LZX match offset!')
+			if off >= l:
+				win += win[i:i+l]
+			else:
+				win += (win[i:] * (l // off + 1))[:l]
+		p.wi, p.bb, p.bn = wi, bb, bn
+		p.R = [R0, R1, R2]
+		n = len(win) - end + n
+		if n > p.left:
+			raise CabArcException('Bad LZX match length!')
+		p.left -= n
+
+	def _undoe8(p, s, pos):
+		"Turns the absolute offsets of E8 (x86 CALL) bytes back to relative, in a frame at stream offset pos"
+		s = bytearray(s)
+		i = s.find(b'\xE8')
+		while 0 <= i < len(s) - 10:
+			a = struct.unpack_from('<l', s, i + 1)[0]
+			if -(pos + i) <= a < p.e8:
+				struct.pack_into('<l', s, i + 1, a >= 0 and a - pos - i or a + p.e8)
+			i = s.find(b'\xE8', i + 5)
+		return bytes(s)
+
+	def decompress(p, s, size=32768):
+		"Decompresses a CFDATA holding the next frame of size bytes"
+		data = p.rest + bytes(s)
+		p.W = list(struct.unpack('<%dH' % (len(data) >> 1), data[:len(data) & ~1])) + [0, 0]
+		p.wi = p.bb = p.bn = p.bp = 0
+		if len(p.win) > 2 * p.size:
+			n = len(p.win) - p.size
+			del p.win[:n]
+			p.base += n
+		start = p.frame
+		p.frame += size
+		while p.base + len(p.win) < p.frame:
+			if not p.left:
+				p._block(data)
+			n = min(p.left, p.frame - p.base - len(p.win))
+			if p.type == 3:
+				p._copy(data, n)
+			else:
+				p._decode(n)
+		if p.type == 3:
+			p.rest = data[p.bp:]
+		else:
+			n = 2 * (p.wi - (p.bn >> 4)) # bits are realigned to 16
+			if n > len(data):
+				raise CabArcException('Bad LZX data: it ends early!')
+			p.rest = data[n:]
+		s = bytes(p.win[start-p.base:p.frame-p.base])
+		if p.e8 and p.e8on and size > 10:
+			s = p._undoe8(s, start)
+		return s
+
+
+def NewMSZIP(type, workers=1, strategy='strict'):
+	if workers != 1:
+		C = ParallelMSZIP(type, workers=workers, strategy=strategy)
+		logging.debug("Set parallel MSZIP compressor with level %d, %d threads", C.level, C.workers)
+	else:
+		C = MSZIP(type, strategy=strategy)
+		logging.debug("Set MSZIP compressor with level %d", C.level)
+	return C
+
+def NewLZX(type, workers=1, strategy='strict'):
+	C = PyLZX(type >> 8)
+	logging.debug("Set LZX compressor with level %d", C.level)
+	return C
+
+# Compressor factories, called as (typeCompress, workers, strategy), by the low byte
+# of a folder type (MSZIP levels 1..9 are type 1): see NewCompressor
+COMPRESSORS = {1: NewMSZIP, 3: NewLZX}
+
+def NewCompressor(type, workers=1, strategy='strict'):
+	"Returns a new compressor for folders of a type (None if uncompressed), from COMPRESSORS"
+	kind = 0 < type < 10 and 1 or type & 0xFF
+	if not kind:
+		return None
+	if kind not in COMPRESSORS:
+		raise CabArcException('Compression type 0x%04X is not supported!' % type)
+	return COMPRESSORS[kind](type, workers, strategy)
 
 
 def info(s):
 	"Prints stuff when operating in application mode"
 	if __name__ != '__main__': return
-	print s
+	print(s)
 
 
 def fmtn(n):
@@ -262,6 +1181,151 @@ def fmtn(n):
 	return ''.join(L)
 
 
+def IsCompressible(name, sample=32768, ratio=0.95):
+	"Tells if a file seems worth compressing, by a fast deflate of its beginning"
+	try:
+		f = open(name, 'rb')
+		s = f.read(sample)
+		f.close()
+	except IOError:
+		return 1
+	if len(s) < 512: # too small to tell (or to matter)
+		return 1
+	return len(zlib.compress(s, 1)) < len(s) * ratio
+
+
+def FolderSample(files, size=65536):
+	"Returns the first size bytes of the files of a folder, as 32 KiB blocks"
+	L, n = [], 0
+	for f in files:
+		if n >= size: break
+		try:
+			fin = open(f.path, 'rb')
+			L += [fin.read(min(f.cbFile, size - n))]
+			fin.close()
+		except IOError:
+			continue
+		n += len(L[-1])
+	s = b''.join(L)
+	return [s[i:i+32768] for i in xrange(0, len(s), 32768)]
+
+
+def TuneLevel(blocks, mbps, strategy='strict'):
+	"Returns the highest MSZIP level compressing the blocks at mbps MB/s at least (1, if none)"
+	# Speed falls as level grows: a binary search takes 3 or 4 trials
+	n = sum([len(s) for s in blocks])
+	lo, hi = 1, 9
+	while lo < hi:
+		level = (lo + hi + 1) // 2
+		C = MSZIP(level, strategy=strategy)
+		t = timer()
+		for s in blocks:
+			C.compress(s)
+		C.flush()
+		if n >= mbps * (1<<20) * (timer() - t):
+			lo = level
+		else:
+			hi = level - 1
+	logging.debug('Level %d compresses %d bytes at %.1f MB/s at least', lo, n, mbps)
+	return lo
+
+
+def FileDigest(name):
+	"Returns the SHA-1 digest of a file's contents, read in chunks (None on errors)"
+	h = hashlib.sha1()
+	try:
+		f = open(name, 'rb')
+		while 1:
+			s = f.read(1<<16)
+			if not s: break
+			h.update(s)
+		f.close()
+	except IOError:
+		return None
+	return h.digest()
+
+
+def DosStat(pathname, st=None):
+	"Returns size, FAT date and time and DOS attributes of a file, from its stat"
+	st = st or os.stat(pathname)
+	x = time.localtime(st.st_mtime)[0:6]
+	date = (x[0] - 1980) << 9 | x[1] << 5 | x[2]
+	tm = x[3] << 11 | x[4] << 5 | x[5] >> 1
+	attrs = 0
+	if not st.st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+		attrs |= 0x1
+	if hasattr(st, 'st_file_attributes'): # Windows, with scandir
+		attrs |= st.st_file_attributes & 0x26 # hidden, system, archive
+	elif sys.platform in ('win32', 'cygwin'):
+		attrs |= (isinstance(pathname, bytes) and windll.kernel32.GetFileAttributesA or windll.kernel32.GetFileAttributesW)(pathname) & 0x26
+	return st.st_size, date, tm, attrs
+
+
+def ListDir(path):
+	"Returns the subdirectories to walk, the names of the files in path and a table of their DosStat"
+	# a table of numbers takes less memory than a tuple for each file
+	dirs, files, table = [], [], (array.array('d'), array.array('H'))
+	def add(name, pathname, st):
+		files.append(name)
+		if st:
+			ds = DosStat(pathname, st)
+			table[0].append(ds[0])
+			table[1].extend(ds[1:])
+		else: # i.e. a broken link
+			table[0].append(-1)
+			table[1].extend((0, 0, 0))
+	try:
+		if scandir:
+			for e in scandir(path):
+				try:
+					if not e.is_dir():
+						add(e.name, e.path, e.stat()) # stat is cached by DirEntry
+					elif not e.is_symlink():
+						dirs += [e.name]
+				except OSError:
+					add(e.name, e.path, None)
+		else:
+			for name in os.listdir(path):
+				pathname = os.path.join(path, name)
+				try:
+					st = os.stat(pathname)
+				except OSError:
+					st = None
+				if not st or not stat.S_ISDIR(st.st_mode):
+					add(name, pathname, st)
+				elif not os.path.islink(pathname):
+					dirs += [name]
+	except OSError:
+		info('WARNING! directory %s skipped!'%(path))
+	return dirs, files, table
+
+
+def ScanTree(top, workers=8):
+	"Yields the (pathname, DosStat) of the files below top, listing many directories at a time"
+	# Order is the same of os.walk(top, topdown=False)
+	tree = {}
+	pool = ThreadPool(workers)
+	level = [top]
+	while level:
+		deeper = []
+		for path, (dirs, files, table) in zip(level, pool.map(ListDir, level)):
+			tree[path] = (dirs, files, table)
+			deeper += [os.path.join(path, x) for x in dirs]
+		level = deeper
+	pool.close()
+	stack = [(top, 0)]
+	while stack:
+		path, i = stack.pop()
+		dirs, files, (sizes, dta) = tree[path]
+		if i < len(dirs): # visit subdirectories first
+			stack += [(path, i+1), (os.path.join(path, dirs[i]), 0)]
+		else:
+			del tree[path] # its stats go as soon as its files are added
+			for j, name in enumerate(files):
+				ds = sizes[j] >= 0 and (int(sizes[j]),) + tuple(dta[3*j:3*j+3]) or None
+				yield os.path.join(path, name), ds
+
+
 def Disk2CabName(name, strip=''):
 # Makes a CAB item name from a pathname
 # WARNING: item name must be <256 bytes (with end NULL)!
@@ -278,57 +1342,74 @@ def Disk2CabName(name, strip=''):
 	return name
 
 	
-class CFDATA:
+class CFDATA(object):
 # Cabinet Data block
-	def __init__(p, data='', udata=0, cdata=0):
-		p.format = '<L2H' # 8 bytes
+	__slots__ = ('data', 'cbData', 'cbUncomp', 'csum', 'dsum', 'abReserve')
+	S = struct.Struct('<L2H') # 8 bytes
+
+	def __init__(p, data=b'', udata=0, cdata=0):
 		p.data = data
 		p.cbData = cdata # length of compressed data in this record
 		p.cbUncomp = udata # length of uncompressed data (or 0 if it continues)
 		p.csum = 0 # checksum: may be omitted (better not)
-		p.abReserve = '' # not used (yet)
+		p.dsum = None # data checksum, if already computed (i.e. by CKSB)
+		p.abReserve = b'' # not used (yet)
 		
 	def size(p): return 8 + p.cbData
 	
 	def isempty(p): return (p.cbData == 0)
 	
-	def Read(p, fp, data=0):
+	def Read(p, fp, data=0, res=0):
 		pos = fp.tell()
 		s = fp.read(8)
 		if len(s) < 8:
 			p.csum, p.cbData, p.cbUncomp = 0, 0, 0
 			return 0
-		s = struct.unpack(p.format,s)
-		p.csum, p.cbData, p.cbUncomp = s
+		p.csum, p.cbData, p.cbUncomp = p.S.unpack(s)
+		p.dsum = None
+		if res: # per-datablock reserved area
+			p.abReserve = fp.read(res)
 		if data:
 			p.data = fp.read(p.cbData)
 		else:
-			p.data = ''
+			p.data = b''
 			fp.seek(p.cbData,1)
 		logging.debug('Read CFDATA @0x%08X: 0x%08X bytes (0x%08X bytes), csum=0x%08X', pos, p.cbData, p.cbUncomp, p.csum)
 		return 1
+
+	def check(p):
+		"Tells if the checksum matches the data read (or is omitted)"
+		if not p.csum: return 1
+		return p.csum == CKS(struct.pack('<2H', p.cbData, p.cbUncomp), CKS(p.data))
 		
 	def Write(p, fp, data=0):
 		pos = fp.tell()
 		if not p.cbData:
 			logging.debug('Discarded empty CFDATA @0x%08X', pos)
 			return 1
-		s = struct.pack(p.format, p.csum, p.cbData, p.cbUncomp)
+		s = p.S.pack(p.csum, p.cbData, p.cbUncomp)
+		buf = p.data # a buffer is written as is, without slicing it
+		if len(buf) != p.cbData:
+			buf = buf[:p.cbData]
 		if CKS:
-			p.csum = CKS(p.data[:p.cbData])
-			p.csum = CKS(s[4:],p.csum)
-		s = struct.pack(p.format, p.csum, p.cbData, p.cbUncomp)
+			if p.dsum is None:
+				p.dsum = CKS(buf)
+			p.csum = CKS(s[4:],p.dsum)
+		s = p.S.pack(p.csum, p.cbData, p.cbUncomp)
 		fp.write(s)
 		if data:
-			fp.write(p.data[:p.cbData])
+			fp.write(buf)
 		logging.debug('Written CFDATA @0x%08X: 0x%08X bytes (0x%08X bytes), csum=0x%08X', pos, p.cbData, p.cbUncomp, p.csum)
 		return 1
 
 
-class CFFILE:
-# Internal Cabinet File structure
+class CFFILE(object):
+# Internal Cabinet File structure (slots keep millions of them small)
+	__slots__ = ('cbFile', 'uoffFolderStart', 'iFolder', 'date', 'time', 'attrs', 'Name', 'path',
+		'_dup', '_cache', '_lf', '_folder')
+	S = struct.Struct('<2L4H') # 16 bytes + sizeof(name) + NULL
+
 	def __init__(p):
-		p.format = '<2L4H' # 16 bytes + sizeof(name) + NULL
 		p.cbFile = 0 # uncompressed file size
 		p.uoffFolderStart = 0 # uncompressed file offset in its folder
 		p.iFolder = 0 # index of folder container
@@ -336,55 +1417,232 @@ class CFFILE:
 		p.date = 0 # FAT-style date, time, attributes
 		p.time = 0
 		p.attrs = 0x20 # 0x01 R  0x02 H  0x04 S  0x20 A  0x40 to exec  0x80 UTF
-		p.Name = '' # item name (max 255?)
+		p.Name = b'' # item name (bytes, max 255?)
 		p.path = '' # source file pathname
+		p._dup = None # [CFFILE] with the same contents, queued before
+		p._cache = None # (key, last CFFILE) of the folder it starts, to cache
 		
 	def size(p): return 16+len(p.Name)+1
+
+	def text(p):
+		"Returns the item name as a string (decoded from UTF-8 or OEM codepage, with Python 3)"
+		if str is bytes:
+			return p.Name
+		return p.Name.decode(p.attrs & 0x80 and 'utf8' or 'cp850')
 	
-	def _adjust(p):
-		p.cbFile = os.stat(p.path)[6]
-		x = time.localtime(os.stat(p.path)[8])[0:6]
-		p.date = (x[0] - 1980) << 9 | x[1] << 5 | x[2]
-		p.time = x[3] << 11 | x[4] << 5 | x[5] >> 1
+	def _adjust(p, ds=None):
+		"Sets size, date, time and attributes from the file DosStat"
+		p.cbFile, p.date, p.time, attrs = ds or DosStat(p.path)
+		p.attrs |= attrs
+
+	def _restore(p, pathname):
+		"Sets date, time and attributes of an extracted file"
+		d, t = p.date, p.time
+		if d:
+			x = time.mktime((1980 + (d >> 9), d >> 5 & 0xF, d & 0x1F, t >> 11, t >> 5 & 0x3F, (t & 0x1F) << 1, 0, 0, -1))
+			os.utime(pathname, (x, x))
+		if sys.platform in ('win32', 'cygwin'):
+			(isinstance(pathname, bytes) and windll.kernel32.SetFileAttributesA or windll.kernel32.SetFileAttributesW)(pathname, p.attrs & 0x27 or 0x80)
+		elif p.attrs & 0x1:
+			os.chmod(pathname, stat.S_IMODE(os.stat(pathname).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
 		
-	def Read(p, fp):
-		s = fp.read(16)
-		s = struct.unpack(p.format,s)
-		(p.cbFile, p.uoffFolderStart, p.iFolder, p.date, p.time, p.attrs) = s
-		s = fp.read(1)
-		while s != '\x00':
-			p.Name += s
-			s = fp.read(1)
-		logging.debug('Read CFFILE=%s, size=%d, off=%d, ind=%d', p.Name, p.cbFile, p.uoffFolderStart, p.iFolder)
-			
+	def Record(p):
+		"Returns the CFFILE as written in the header"
+		return p.S.pack(p.cbFile, p.uoffFolderStart, p.iFolder, p.date, p.time, p.attrs) + p.Name + b'\x00'
+
 	def Write(p, fp):
-		s = struct.pack(p.format, p.cbFile, p.uoffFolderStart, p.iFolder, p.date, p.time, p.attrs)
-		fp.write(s)
-		fp.write(p.Name+'\x00')
+		fp.write(p.Record())
+
+	def Pack(p):
+		"Returns the CFFILE record followed by the source pathname, in a single string"
+		return p.Record() + fsbytes(p.path)
+
+	@staticmethod
+	def Unpack(s):
+		"Returns the CFFILE of a string made by Pack"
+		f = CFFILE()
+		f.cbFile, f.uoffFolderStart, f.iFolder, f.date, f.time, f.attrs = f.S.unpack_from(s)
+		i = s.index(b'\x00', 16)
+		f.Name, f.path = s[16:i], fstext(s[i+1:])
+		return f
 		
 
+class Prefetcher:
+# Opens and reads the input files in a thread, some chunks ahead of the block
+# assembler: it looks like the file actually read, to IOStream._read
+	def __init__(p, files, depth=16):
+		p.q = queue.Queue(depth)
+		p.chunk, p.ofs = b'', 0 # chunk being consumed
+		p.eof = 1
+		p.t = threading.Thread(target=p._run, args=(files,))
+		p.t.daemon = True
+		p.t.start()
+
+	def _run(p, files):
+		"Queues (item, error) when a file is opened, then its chunks and an empty one"
+		for o in files:
+			f = isinstance(o, bytes) and CFFILE.Unpack(o) or o
+			try:
+				fin = io.open(f.path, 'rb', buffering=0)
+			except (IOError, OSError) as e:
+				p.q.put((o, e))
+				continue
+			p.q.put((o, None))
+			left = f.cbFile # a file is read up to its size in CFFILE
+			try:
+				while left:
+					s = bytearray(min(left, 32768))
+					x = fin.readinto(s)
+					if not x: break # truncated: IOStream fills the gap
+					left -= x
+					p.q.put((o, memoryview(s)[:x]))
+			except (IOError, OSError):
+				pass
+			fin.close()
+			p.q.put((o, b''))
+
+	def open(p, o):
+		"Returns itself as the opened file of the queue item o, or raises the error met opening it"
+		g, e = p.q.get()
+		assert g is o
+		if e: raise e
+		p.chunk, p.ofs, p.eof = b'', 0, 0
+		return p
+
+	def readinto(p, b):
+		if p.ofs == len(p.chunk):
+			if p.eof: return 0
+			p.chunk, p.ofs = p.q.get()[1], 0
+			if not p.chunk:
+				p.eof = 1
+				return 0
+		k = min(len(b), len(p.chunk) - p.ofs)
+		b[:k] = p.chunk[p.ofs:p.ofs+k]
+		p.ofs += k
+		return k
+
+	def close(p):
+		"Discards what's left of the file"
+		while not p.eof:
+			p.eof = not p.q.get()[1]
+
+
+class Metrics:
+# Time (summed over threads) and bytes of each stage of a build, plus per file
+# (count, totals and the slowest) and per folder timings; if set, hook(event, secs,
+# bytes, name) is called at each one. Stages are read (files, or folders copied
+# from other cabinets), compress, checksum, write (CFDATA) and copy (closing a
+# cabinet unit: moving its CFDATA, if the header outgrew its room, and writing
+# the header). A Cabinet records them only if given one (see NoMetrics)
+	STAGES = ('read', 'compress', 'checksum', 'write', 'copy')
+
+	def __init__(p):
+		p.time = dict.fromkeys(p.STAGES, 0.0)
+		p.bytes = dict.fromkeys(p.STAGES, 0)
+		p.calls = dict.fromkeys(p.STAGES, 0)
+		p.files = [0, 0, 0.0, 0.0] # files read, their bytes, seconds and the most spent on one
+		p.folders = [] # (type, bytes read, bytes written, seconds) of each folder
+		p.hook = None
+		p.lock = threading.Lock() # stages run in pipeline threads, too
+
+	def add(p, stage, secs, n, name=''):
+		p.lock.acquire()
+		p.time[stage] += secs
+		p.bytes[stage] += n
+		p.calls[stage] += 1
+		p.lock.release()
+		if p.hook:
+			p.hook(stage, secs, n, name)
+
+	def file(p, f, secs):
+		"Records the time spent reading a file (a CFFILE)"
+		p.lock.acquire() # pooled folders are read by many threads
+		x = p.files
+		x[0] += 1
+		x[1] += f.cbFile
+		x[2] += secs
+		x[3] = max(x[3], secs)
+		p.lock.release()
+		if p.hook:
+			p.hook('file', secs, f.cbFile, f.text())
+
+	def folder(p, type, nin, nout, secs):
+		p.folders += [(type, nin, nout, secs)]
+		if p.hook:
+			p.hook('folder', secs, nin, str(len(p.folders) - 1))
+
+	def Dump(p, fmt='json', totals={}):
+		"Returns the metrics (and some totals) as JSON or Prometheus text format"
+		if fmt == 'json':
+			return json.dumps({'stages': dict([(x, {'seconds': p.time[x], 'bytes': p.bytes[x], 'calls': p.calls[x]}) for x in p.STAGES]),
+			'files': dict(zip(('count', 'bytes', 'seconds', 'seconds_max'), p.files)),
+			'folders': [{'type': a, 'bytes_read': b, 'bytes_written': c, 'seconds': d} for a, b, c, d in p.folders],
+			'totals': totals}, indent=1)
+		L = []
+		for name, what, D in (('seconds', 'Time spent', p.time), ('bytes', 'Bytes processed', p.bytes), ('calls', 'Calls', p.calls)):
+			L += ['# HELP pycabarc_stage_%s_total %s in each stage' % (name, what), '# TYPE pycabarc_stage_%s_total counter' % name]
+			L += ['pycabarc_stage_%s_total{stage="%s"} %s' % (name, x, D[x]) for x in p.STAGES]
+		for name, n in [('files_read', p.files[0]), ('file_seconds', p.files[2]), ('folders', len(p.folders))] + sorted(totals.items()):
+			L += ['# TYPE pycabarc_%s_total counter' % name, 'pycabarc_%s_total %s' % (name, n)]
+		if p.files[0]:
+			L += ['# TYPE pycabarc_file_seconds_max gauge', 'pycabarc_file_seconds_max %s' % p.files[3]]
+		if p.folders:
+			L += ['# TYPE pycabarc_folder_seconds_max gauge', 'pycabarc_folder_seconds_max %s' % max([x[3] for x in p.folders])]
+		return '\n'.join(L) + '\n'
+
+
+class NoMetrics(Metrics):
+# The metrics of a Cabinet nobody asked for: events are dropped (no lock, no hook)
+	def add(p, stage, secs, n, name=''): pass
+
+	def file(p, f, secs): pass
+
+	def folder(p, type, nin, nout, secs): pass
+
+
 class IOStream:
 # Helps transforming a continuous (per-folder) 32K input stream into a per-cabinet
 # (eventually compressed) CFDATA output stream...
-	def __init__(p, cabset, compression):
+	def __init__(p, cabset, compression, workers=1, depth=0, readahead=0, strategy='strict'):
 		p.C = cabset
-		if 0 < compression < 10:
-			p.CPR = MSZIP(compression) # default compressor
-			logging.debug("Set MSZIP compressor with level %d", p.CPR.level)
-		elif (compression & 0xFF) == 3:
-			p.CPR = LZX(compression >> 8)
-			logging.debug("Set LZX compressor with level %d", p.CPR.level)
-		else:
-			logging.debug("Set NONE compressor")
+		p.workers, p.strategy = workers, strategy
+		p.batch = workers != 1 and 4 * (workers or cpu_count()) or 0 # blocks compressed at a time by a parallel compressor
+		# With depth, reading (readahead chunks ahead), compression plus checksum
+		# (depth blocks ahead) and writing are pipelined on different threads
+		p.depth = depth
+		p.readahead = readahead or 4 * depth
+		p.pf = 0 # Prefetcher
+		p.fpool = 0 # FolderPool compressing whole folders ahead
+		p.pending = collections.deque() # blocks in compression, to write in order
+		p.stage = depth and ThreadPool(1) # compression thread, for a serial compressor
+		p.compressors = {} # folder type: compressor
+		p.CPR = p._compressor(6 if compression is None else compression) # compressor of the actual folder
 		p.fin = 0 # file actually read
-		p.fout = [tempfile.TemporaryFile()] # temp files
-		p._files = [] # files to process
+		p.fout = 0 # cabinet unit actually written
+		p.R = 0 # bytes reserved in fout for the header
+		p._files = collections.deque() # files (packed, if possible) and new folder types to process
 		p._file = 0 # CFFILE worked on
 		p.limit = p.C.limit
-		p.buf = '' # data buffer
+		# Input blocks are assembled in place: a ring of 32 KiB buffers lets a
+		# batch (plus its tail, plus the history block) stay untouched till compressed
+		p.ring = [bytearray(32768) for i in range(max(p.batch+2, p.depth and p.depth+3 or 1))]
+		p.k = 0 # ring buffer being filled
+		p.view = memoryview(p.ring[0])
+		p.n = 0 # bytes in it
+		p.left = 0 # bytes still to read from the input file
+		p.buf = b'' # (compressed) block to write
 		p.ulen, p.clen = 0, 0
+		p.done = 0 # uncompressed bytes of the folder in whole CFDATA
 		p.opened = [] # files across cabinets
+		p.packed = (None, 0) # items list of the actual folder, and how many of them are packed
 		p._flushing = 0 # close folder ASAP flag
+		p._newtype = None # compression type for the next folder, if changed
+		p.lf = 0 # logical folder being written (continued ones included)
+		p.rec = None # [key, last CFFILE, logical folder, file with its CFDATA] of a folder to cache
+		p.ft = 0 # time the actual file was opened
+		p.fs = (0, 0, 0) # time, bytes read and written when the actual folder began
+		p.total = [0, 0] # files and bytes to write
+		p.sofar = [0, 0] # files and bytes written
 		p.c1, p.c2 = 0, 0 # total bytes read, written
 		p.c3, p.c4 = 0, 0 # total files opened, cabinets written
 		
@@ -396,16 +1654,56 @@ class IOStream:
 # In a cabinet set, a folder (and, so, its last file) is closed as soon as
 # the maximum cabinet unit size has been reached
 			p._flushing = 0
-			p.C._addfolder(p.C.ch[-1].Folders[-1].typeCompress)
+			if p._newtype is None:
+				p._newtype = p.C.ch[-1].Folders[-1].typeCompress
+			p._drain(0)
+			F = p.C.ch[-1].Folders[-1]
+			if F.Files or F.cCFData:
+				p._endfolder()
+				p.C._addfolder(p._newtype)
+				p.done = 0
+			else: # the actual folder got nothing: it just changes type
+				F.typeCompress = p._newtype
+			p.CPR = p._compressor(p._newtype) or p.CPR
+			p._newtype = None
+			p.lf += 1
+		while p._files and isinstance(p._files[0], CFFILE) and p._alias(p._files[0]):
+			p._files.popleft()
 		if not p._files: return 0
-		p._file = p._files.pop(0)
-		info('  adding: '+p._file.Name)
+		if isinstance(p._files[0], FolderCopy):
+			F = p.C.ch[-1].Folders[-1]
+			if F.Files or F.cCFData:
+				p._newtype = p._files[0].type # close the actual folder first
+			else:
+				F.typeCompress = p._files[0].type
+				p._copyfolder(p._files.popleft())
+			p._flushing = 1
+			return 0
+		if not isinstance(p._files[0], (CFFILE, bytes)):
+			# a new folder was requested: close the actual one
+			p._newtype = p._files.popleft()
+			p._flushing = 1
+			return 0
+		o = p._files.popleft()
+		p._file = isinstance(o, bytes) and CFFILE.Unpack(o) or o
+		info('  adding: '+p._file.text())
 		try:
-			p._file._adjust()
-			p.fin = file(p._file.path,'rb')
+			if p.pf and not p._file._dup:
+				p.fin = p.pf.open(o)
+			else:
+				p.fin = io.open(p._file.path, 'rb', buffering=0)
 		except:
 			info('WARNING! file %s skipped!'%(p._file.path))
+			if p.rec: # the folder won't hold what its key says
+				p.C.cache.discard(p.rec[3])
+			p.rec = None
 			return 0
+		p.left = p._file.cbFile
+		p.ft = timer()
+		p._file._lf = p.lf
+		if p._file._cache:
+			p.rec = [p._file._cache[0], p._file._cache[1], p.lf, p.C.cache.open()]
+		p._pack()
 		P = p.C.ch[-1].Folders
 		p._file.iFolder = len(P) - 1
 		p._file.uoffFolderStart = P[-1].Size
@@ -414,47 +1712,222 @@ class IOStream:
 		p.c3 += 1
 		return 1
 		
-	def _cabsize(p): return p.fout[-1].tell() + p.C.ch[-1].size()
+	def _pack(p):
+		"Packs the items of the actual folder whose data is all written, since they won't change"
+		L, i = p.packed
+		if L is not p.C.ch[-1].Folders[-1].Files:
+			L, i = p.C.ch[-1].Folders[-1].Files, 0
+		while i < len(L) and (isinstance(L[i], bytes) or L[i].uoffFolderStart + L[i].cbFile <= p.done):
+			L[i] = isinstance(L[i], bytes) and L[i] or L[i].Record()
+			i += 1
+		p.packed = (L, i)
+
+	def _compressor(p, type):
+		"Returns the compressor of the folders of a type, made once from the registry"
+		if type not in p.compressors:
+			p.compressors[type] = NewCompressor(type, p.workers, p.strategy)
+		return p.compressors[type]
+
+	def _alias(p, f):
+		"Lists a duplicate file at the offset of its first copy, if in the same folder"
+		if not f._dup:
+			return 0
+		o = f._dup[0]
+		if getattr(o, '_lf', -1) != p.lf:
+			# the first copy is in another folder: this one will take its place
+			f._dup[0] = f
+			return 0
+		info('  adding: %s (same as %s)' % (f.text(), o.text()))
+		f._lf = p.lf
+		P = p.C.ch[-1].Folders
+		f.iFolder = len(P) - 1
+		f.uoffFolderStart = o.uoffFolderStart
+		P[-1].Files += [f]
+		p.c3 += 1
+		p._progress(f)
+		return 1
+
+	def _progress(p, f):
+		"Counts a file as written, telling the progress callback"
+		p.sofar[0] += 1
+		p.sofar[1] += f.cbFile
+		if p.C.progress:
+			p.C.progress(p.sofar[0], p.total[0], p.sofar[1], p.total[1])
+
+	def _endfolder(p):
+		"Records the timing of the folder just ended, and caches it if needed"
+		t, c1, c2 = p.fs
+		p.C.metrics.folder(p.C.ch[-1].Folders[-1].typeCompress, p.c1 - c1, p.c2 - c2, timer() - t)
+		p.fs = (timer(), p.c1, p.c2)
+		p._keep()
+
+	def _keep(p):
+		"Stores the folder just written in cache, if it holds all the files its key was made of"
+		if p.rec and getattr(p.rec[1], '_lf', -1) == p.rec[2]:
+			p.C.cache.put(p.rec[0], p.rec[3])
+		elif p.rec:
+			p.C.cache.discard(p.rec[3])
+		p.rec = None
+
+	def _cabsize(p): return p.fout.tell() - p.R + max(p.R, p.C.ch[-1].size())
+
+	def _datapos(p):
+		"Returns the offset of the next CFDATA, from the first one in the cabinet"
+		return p.fout and p.fout.tell() - p.R
+
+	def _newcab(p):
+		"Starts writing the CFDATA of a cabinet unit, after room for its header"
+		h = p.C.ch[-1]
+		p.R = h.size()
+		# Reserve room for all pending items, or for those that should fit in a
+		# unit of a set (at the compression ratio seen so far), after the data
+		# still to come from the file being written
+		ratio = p.c1 and float(p.c2)/p.c1 or 1.0
+		room = p.limit - p.R - (p.left + p.n + 32768 * len(p.pending)) * ratio
+		F = h.Folders[-1]
+		data = F.Files or F.cCFData # else a new type (or copy) just retypes it
+		for o in p._files:
+			if room <= 0: break
+			if isinstance(o, bytes): # a packed CFFILE
+				n = o.index(b'\x00', 16) + 1
+				p.R += n
+				room -= n + CFFILE.S.unpack_from(o)[0] * ratio
+				data = 1
+				continue
+			if isinstance(o, CFFILE):
+				p.R += o.size()
+				room -= o.size() + o.cbFile * ratio
+				data = 1
+				continue
+			if data:
+				p.R += 8
+				room -= 8
+			data = 0
+			if isinstance(o, FolderCopy):
+				for f in o.files:
+					p.R += f.size()
+					room -= f.size() + f.cbFile * ratio
+				data = 1
+		if room > 0 and h.flags & 0x2:
+			p.R -= len(h.szCabinetNext) + len(h.szDiskNext) # probably the last unit
+		p.fout = open(p.C.lastname,'w+b')
+		p.fout.seek(p.R)
+		logging.debug('Started cabinet %s, %d bytes reserved for header', p.C.lastname, p.R)
+
+	def _fitheader(p):
+		"Makes the header fill the room reserved for it, or moves the CFDATA"
+		h = p.C.ch[-1]
+		d = p.R - h.size()
+		logging.debug('Header of %s: %d bytes, %d reserved', p.C.lastname, h.size(), p.R)
+		if not d:
+			return
+		# a few bytes of padding cost less than moving the CFDATA, but the
+		# reserved area asked by the user (-s) never changes
+		if 0 < d <= p.limit >> 10 and not (p.C.reserved or h.cbCFFolder or h.cbCFData):
+			if not h.flags & 0x4:
+				d -= 4 # cbCFHeader, cbCFFolder and cbCFData fields
+			if 0 <= d and h.cbCFHeader + d <= 60000:
+				# pads with the per-cabinet reserved area
+				h.flags |= 0x4
+				h.cbCFHeader += d
+				h.abReserve += d * b'\x00'
+				return
+		p._move(p.R, h.size())
+
+	def _move(p, src, dst):
+		"Moves the CFDATA of the current cabinet from offset src to dst"
+		f = p.fout
+		f.seek(0, 2)
+		n = max(0, f.tell() - src)
+		logging.debug('Moving %d bytes of CFDATA from 0x%08X to 0x%08X', n, src, dst)
+		if dst > src: # backwards, so that nothing is overwritten
+			i = n
+			while i > 0:
+				k = min(i, 1<<20)
+				i -= k
+				f.seek(src+i)
+				s = f.read(k)
+				f.seek(dst+i)
+				f.write(s)
+		else:
+			i = 0
+			while i < n:
+				k = min(n-i, 1<<20)
+				f.seek(src+i)
+				s = f.read(k)
+				f.seek(dst+i)
+				f.write(s)
+				i += k
+			f.truncate(dst+n)
+		p.R = dst
 	
 	def _cabisfull(p): return (p._cabsize() >= p.limit)
 	
 	def _read(p, n=32768):
-		if not p.fin and not p._open():
-			return 0
-		n -= len(p.buf)
-		s = p.fin.read(n)
-		x = len(s)
-		if not x:
-			p.fin.close()
-			p.fin = 0
-			return 0
-		p.buf += s
-		p.c1 += x
-		logging.debug('Buffer: %d/32768 (wanted %d, read %d from %s)', len(p.buf), n, x, p._file.path)
-		if len(p.buf) < 32768:
-			p.fin = 0
-			if p._cabisfull() or p._flushing:
+		"Fills the block buffer from the input files: returns 1 when it is full"
+		while p.n < n:
+			if not p.fin and not p._open():
 				return 0
-			return p._read(n-x)
+			if not p.left:
+				# file ended: go on with the next one, if the folder goes on
+				p.fin.close()
+				p.fin = 0
+				p.C.metrics.file(p._file, timer() - p.ft)
+				p._progress(p._file)
+				if p.pending:
+					p._settle()
+				if p._cabisfull() or p._flushing:
+					return 0
+				continue
+			k = min(n - p.n, p.left)
+			t = timer()
+			x = p.fin.readinto(p.view[p.n:p.n+k])
+			p.C.metrics.add('read', timer() - t, x or 0)
+			if not x:
+				# the file shrank after it was listed: CFFILE size is honored
+				info('WARNING! file %s truncated!'%(p._file.path))
+				p.ring[p.k][p.n:p.n+k] = bytearray(k)
+				x = k
+			p.n += x
+			p.left -= x
+			p.c1 += x
+			logging.debug('Buffer: %d/32768 (wanted %d, read %d from %s)', p.n, k, x, p._file.path)
 		return 1
-		
+
+	def _take(p):
+		"Returns the assembled block (as a buffer) and goes to the next one of the ring"
+		s = buffer(p.ring[p.k], 0, p.n)
+		p.k = (p.k + 1) % len(p.ring)
+		p.view = memoryview(p.ring[p.k])
+		p.n = 0
+		return s
+
 	def _filter(p, flush):
-		p.clen = p.ulen = len(p.buf)
-		if p.C.ch[-1].Folders[-1].typeCompress and p.ulen: # try to compress only if not zero
-			p.buf = p.CPR.compress(p.buf)
-			if flush:
-				p.buf += p.CPR.flush()
+		p.clen = p.ulen = p.n
+		p.buf = p._take()
+		if p.C.ch[-1].Folders[-1].typeCompress:
+			t = timer()
+			s = b''
+			if p.ulen: # try to compress only if not zero
+				s = p.CPR.compress(p.buf)
+			if flush: # the compressor is reset even if no data is left
+				end = p.CPR.flush()
+				if p.ulen:
+					s += end
+			p.buf = s
 			p.clen = len(p.buf)
+			p.C.metrics.add('compress', timer() - t, p.ulen)
 		p.c2 += p.clen
 		
 	def _copycab(p, last=0):
 		logging.debug('Flushing cabinet #%d...', p.C.Index)
 		info('Flushing cabinet #%d...'%(p.C.Index))
 		X = p.C.ch[-1].Folders[-1]
-# Properly set iFolder member for CFFILEs
+# Properly set iFolder member for CFFILEs: a file continues in the next cabinet
+# if it ends past the whole CFDATA of the folder (offsets are from the folder's
+# start, even in a continued one)
 		for x in X.Files:
-			if x.uoffFolderStart >= (X.cCFData-1)*32768 or \
-				  x.uoffFolderStart + x.cbFile >= (X.cCFData-1)*32768:
+			if not isinstance(x, bytes) and x.uoffFolderStart + x.cbFile > p.done:
 				if x.iFolder in [0xFFFD, 0xFFFF]:
 					if last:
 						x.iFolder = 0xFFFD
@@ -464,90 +1937,569 @@ class IOStream:
 					if not last:
 						x.iFolder = 0xFFFE
 				p.opened += [x]
-		f = file(p.C.lastname,'wb')
-		p.C.ch[-1].Write(f)
+# CFDATA are already in place: the header is written in the room before them
+		t = timer()
+		h = p.C.ch[-1]
+		p.fout.seek(0, 2)
+		n = max(0, p.fout.tell() - p.R) # no CFDATA, if the files are empty
+		p._fitheader()
+		h.cbCabinet = h.size() + n
+		h.Write(p.fout)
+		p.C.metrics.add('copy', timer() - t, h.cbCabinet)
+		for F in h.Folders:
+			F.Files = [] # written: only the continued ones (p.opened) are kept
+			F._sized = (None, 0, 8) # nor does size() keep the old list
+		p.packed = (None, 0)
 		for x in p.opened:
 			if x.iFolder in [0xFFFE,0xFFFF]:
 				x.iFolder = 0xFFFD
-		c = CFDATA()
-		while c.Read(p.fout[-1],1):
-			c.Write(f,1)
-		p.fout[-1].close() # discard temp file
+		p.fout.close()
+		p.fout = 0
 		p.c4 += 1
 		
 	def _write(p, end):
-		if not end and len(p.buf) < 32768:
+		if not end and p.n < 32768:
 			return 0
+		if p.depth:
+			return p._submit(end)
 		p._filter(end)
+		return p._emit()
+
+	def _stage(p, job):
+		"Compresses (if required) and checksums a block, in a pipeline thread"
+		s, hist, how, flush = job
+		buf = s
+		t = timer()
+		if how == 1: # serial compressor
+			buf = s and p.CPR.compress(s) or b''
+			if flush:
+				end = p.CPR.flush()
+				if s:
+					buf += end
+		elif how == 2: # parallel compressor, with the block's history
+			buf = s and p.CPR._block((s, hist)) + flush or b''
+		if how:
+			p.C.metrics.add('compress', timer() - t, len(s))
+		t = timer()
+		dsum = CKS(buf)
+		p.C.metrics.add('checksum', timer() - t, len(buf))
+		return buf, len(s), dsum
+
+	def _submit(p, flush):
+		"Passes the assembled block to the compression stage of the pipeline"
+		s = p._take()
+		how = p.C.ch[-1].Folders[-1].typeCompress and 1
+		hist, pool = None, p.stage
+		if how and isinstance(p.CPR, ParallelMSZIP):
+			how, pool = 2, p.CPR.pool
+			if s:
+				hist = p.CPR.jobs([s])[0][1]
+			# here flush carries the bytes ending the folder's stream
+			flush = flush and p.CPR.flush() or b''
+		p.pending.append(pool.apply_async(p._stage, ((s, hist, how, flush),)))
+		# a block may be split across cabinets only when it's the last one written
+		if not p._settle():
+			p._drain(p.depth)
+		return 1
+
+	def _settle(p):
+		"Writes all the pending blocks if one of them could be split across cabinets"
+		if p._cabsize() + (len(p.pending) + 1) * 32788 >= p.limit:
+			p._drain(0)
+			return 1
+		return 0
+
+	def _drain(p, n):
+		"Writes the pending blocks, in order, till n are left"
+		while len(p.pending) > n:
+			p.buf, p.ulen, dsum = p.pending.popleft().get()
+			p.clen = len(p.buf)
+			p.c2 += p.clen
+			p._emit(dsum)
+
+	def _emit(p, dsum=None):
+		"Writes the (compressed) block in buffer, splitting it across cabinets if needed"
 		s = p.buf
-		p.buf = ''
+		p.buf = b''
+		if not p.clen:
+			return 0 # nothing to write: don't count an empty CFDATA
+		if p.rec:
+			p.C.cache.write(p.rec[3], p.ulen, s)
 		x = CFDATA(s,p.ulen,p.clen)
+		x.dsum = dsum
 		logging.debug('actual CAB sizes: %d -> %d bytes', p._cabsize(), p._cabsize()+x.size())
 		p.C.ch[-1].Folders[-1].cCFData += 1
-		if p._cabsize() + x.size() < p.limit:
-			x.Write(p.fout[-1],1)
+		if p._cabsize() + x.size() <= p.limit:
+			p._put(x)
+			p.done += p.ulen
 			return 1
-		x.cbUncomp = 0
-		x.cbData = p.limit - p._cabsize() - 8
-		x.Write(p.fout[-1],1) # Write part
-		p.fout[-1].seek(0)
+		room = p.limit - p._cabsize() - 8
+		if room > 0:
+			x.cbUncomp = 0
+			x.cbData = room
+			x.dsum = None
+			p._put(x) # Write part
+		else: # not even a byte fits: the whole block goes to the next unit
+			p.C.ch[-1].Folders[-1].cCFData -= 1
+			room = 0
 		p._copycab()
-		x = CFDATA(s[x.cbData:],p.ulen,p.clen-x.cbData)
-		p.fout += [tempfile.TemporaryFile()]
+		x = CFDATA(s[room:],p.ulen,p.clen-room)
 		t = p.C.ch[-1].Folders[-1].typeCompress
 		p.C.AddHeader()
 # The 1st folder contains only residual data...
 		p.C._addfolder(t)
 		p.C.ch[-1].Folders[-1].cCFData += 1
 		p.C.ch[-1].Folders[-1].Files += p.opened
-		x.Write(p.fout[-1],1) # Write residual bytes
+		p._newcab()
+		p._put(x) # Write residual bytes
+		p.done += p.ulen
 		p.opened = []
 		p._flushing = 1 # signal to close folder
 
-	def push(p, item):
-		p._files += [item]
+	def _put(p, x):
+		"Writes a CFDATA, timing its checksum and write"
+		if x.dsum is None:
+			t = timer()
+			buf = x.data
+			if len(buf) != x.cbData:
+				buf = buf[:x.cbData]
+			x.dsum = CKS(buf)
+			p.C.metrics.add('checksum', timer() - t, x.cbData)
+		t = timer()
+		x.Write(p.fout,1)
+		p.C.metrics.add('write', timer() - t, x.size())
+
+	def _copyfolder(p, X):
+		"Writes the CFDATA of a folder of another cabinet again, as they are"
+		info('  %s %s' % (X.verb, X.name))
+		p._drain(0)
+		blocks = X.blocks() # a pooled folder knows its files once compressed
+		files = collections.deque(sorted(X.files, key=lambda x: x.uoffFolderStart))
+		u = 0
+		t = timer()
+		for size, s in blocks:
+			if not X.timed:
+				p.C.metrics.add('read', timer() - t, len(s))
+			u += size
+			# files are listed once their data begins, like _open does
+			P = p.C.ch[-1].Folders
+			while files and files[0].uoffFolderStart < u:
+				f = files.popleft()
+				f.iFolder = len(P) - 1
+				P[-1].Size = max(P[-1].Size, f.uoffFolderStart + f.cbFile)
+				P[-1].Files += [f]
+				p.c3 += 1
+				p._progress(f)
+			p.buf, p.ulen, p.clen = s, size, len(s)
+			p.c1 += p.ulen
+			p.c2 += p.clen
+			p._emit()
+			t = timer()
+		P = p.C.ch[-1].Folders
+		for f in files: # empty ones at folder's end
+			f.iFolder = len(P) - 1
+			P[-1].Files += [f]
+			p.c3 += 1
+			p._progress(f)
+
+	def push(p, item, pack=0):
+		"Queues an item: a CFFILE nothing else refers to may be packed, to take little memory"
+		if pack and isinstance(item, CFFILE) and isinstance(item.path, str):
+			item = item.Pack()
+		p._files.append(item)
+
+	def unpack(p):
+		"Turns the packed items of the queue into CFFILE again"
+		p._files = collections.deque([isinstance(o, bytes) and CFFILE.Unpack(o) or o for o in p._files])
+
+	def close(p):
+		"Stops the threads of the pipeline and of a parallel compressor"
+		for o in [p.stage, p.fpool and p.fpool.pool] + [getattr(C, 'pool', 0) for C in p.compressors.values()]:
+			if o:
+				o.close()
+				o.join()
 
 	def flush(p, end=0):
-		while p._read():
-			p._write(end)
-		p._write(p._flushing | end)
+		if not p.fout:
+			p._newcab()
+			p.fs = (timer(), p.c1, p.c2)
+			p.CPR = p._compressor(p.C.ch[-1].Folders[-1].typeCompress) or p.CPR
+		if end and p.depth and p.readahead and not p.fin:
+			p.pf = Prefetcher([o for o in p._files if isinstance(o, bytes) or isinstance(o, CFFILE) and not o._dup], p.readahead)
+		if p.batch and not p.depth:
+			p._flushbatch(end)
+		while not p.batch or p.depth:
+			while p._read():
+				p._write(0)
+			p._write(p._flushing | end)
+			if not end or not (p._files or p.fin): break
+		p._drain(0)
+		if end:
+			p._endfolder()
+		p.pf = 0
+
+	def _flushbatch(p, end):
+		"Like flush, but reads and compresses up to p.batch blocks at a time"
+		while 1:
+			more = 1
+			while more:
+				blocks = []
+				while len(blocks) < p.batch:
+					# a cabinet split may only happen at the last block of a batch
+					if blocks and p._cabsize() + (len(blocks)+1) * 32788 >= p.limit:
+						break
+					more = p._read()
+					if not more: break
+					blocks += [p._take()]
+				if not blocks: continue
+				cblocks = blocks
+				if p.C.ch[-1].Folders[-1].typeCompress:
+					t = timer()
+					if isinstance(p.CPR, ParallelMSZIP):
+						cblocks = p.CPR.map(blocks)
+					else:
+						cblocks = [p.CPR.compress(s) for s in blocks]
+					p.C.metrics.add('compress', timer() - t, sum([len(s) for s in blocks]))
+				t = timer()
+				dsums = CKSB(cblocks)
+				p.C.metrics.add('checksum', timer() - t, sum([len(s) for s in cblocks]))
+				for s, buf, dsum in zip(blocks, cblocks, dsums):
+					p.buf, p.ulen, p.clen = buf, len(s), len(buf)
+					p.c2 += p.clen
+					p._emit(dsum)
+			p._write(p._flushing | end)
+			if not end or not (p._files or p.fin): break
+
+
+class FolderCopy:
+# A folder of a cabinet being read, to write again without recompressing it
+	verb = 'copying'
+	timed = 0 # its blocks are read (and timed) by a worker
+
+	def __init__(p, cab, index, files):
+		p.cab = cab
+		p.index = index # logical folder in cab
+		p.type = cab.folders[index][0][1].typeCompress
+		p.files = files # new CFFILEs (with the same offsets)
+		p.name = 'folder #%d of %s' % (index, cab.destname)
+
+	def blocks(p):
+		"Yields the (uncompressed size, data) of each CFDATA"
+		for size, s, parts in p.cab._blocks(p.index):
+			yield size, s
+
+
+class CachedFolder(FolderCopy):
+# A folder whose CFDATA were found in a FolderCache
+	def __init__(p, cache, type, files, key):
+		p.cache = cache
+		p.type = type
+		p.files = files # CFFILEs, with offsets set
+		p.key = key
+		p.name = 'cached folder %s' % key[:16]
+
+	def blocks(p): return p.cache.blocks(p.key)
+
+
+class PooledFolder(FolderCopy):
+# A run of files making a folder of its own, read and compressed by a FolderPool
+# while the folders before it are written
+	verb = 'adding'
+	timed = 1
+
+	def __init__(p, pool, cab, type, files, how, key=None):
+		p.pool = pool
+		p.C = cab
+		p.type = type
+		p.files = files # CFFILEs: offsets are set (and unreadable ones dropped) by compress
+		p.how = how # MSZIP level, mem and strategy
+		p.key = key # FolderCache key, to store the folder once compressed
+		p.whole = 1 # all files were read
+		p.job = None
+		p.name = 'folder of %d files' % len(files)
+
+	def compress(p):
+		"Reads the files as a new folder and compresses it: returns its CFDATA"
+		M = p.C.metrics
+		C = MSZIP(*p.how)
+		L, files, placed = [], [], set()
+		block = bytearray(32768)
+		view = memoryview(block)
+		n, u = 0, 0
+		for f in p.files:
+			if f._dup and id(f._dup[0]) in placed:
+				f.uoffFolderStart = f._dup[0].uoffFolderStart
+				files += [f]
+				continue
+			try:
+				fin = io.open(f.path, 'rb', buffering=0)
+			except (IOError, OSError):
+				info('WARNING! file %s skipped!'%(f.path))
+				p.whole = 0
+				continue
+			ft = timer()
+			f.uoffFolderStart = u
+			files += [f]
+			placed.add(id(f))
+			left = f.cbFile
+			while left:
+				k = min(32768 - n, left)
+				t = timer()
+				x = fin.readinto(view[n:n+k])
+				M.add('read', timer() - t, x or 0)
+				if not x:
+					info('WARNING! file %s truncated!'%(f.path))
+					block[n:n+k] = bytearray(k)
+					x = k
+				n += x
+				u += x
+				left -= x
+				if n == 32768:
+					t = timer()
+					L += [(n, C.compress(buffer(block, 0, n)))]
+					M.add('compress', timer() - t, n)
+					n = 0
+			fin.close()
+			M.file(f, timer() - ft)
+		t = timer()
+		s = n and C.compress(buffer(block, 0, n))
+		end = C.flush()
+		if n: # like IOStream, the stream ends with the last block
+			L += [(n, s + end)]
+		M.add('compress', timer() - t, n)
+		p.files = files
+		return L
+
+	def blocks(p):
+		"Waits for the CFDATA of the folder (storing them in cache, if it has a key)"
+		L = p.pool.get(p)
+		if p.key and p.whole:
+			p.C.cache.put(p.key, L)
+		return L
+
+
+class FolderPool:
+# Compresses whole folders (each one a new MSZIP stream) on a pool of threads,
+# since zlib and file reads release the GIL: at most workers folders are kept
+# ahead of the one being written
+	def __init__(p, workers=0):
+		p.workers = workers or cpu_count()
+		p.pool = ThreadPool(p.workers)
+		p.folders = [] # PooledFolder, in writing order
+		p.i = 0 # next folder to submit
+
+	def add(p, X):
+		X.n = len(p.folders)
+		p.folders += [X]
+
+	def ahead(p, n):
+		"Submits the folders up to the n-th"
+		while p.i < min(n, len(p.folders)):
+			X = p.folders[p.i]
+			X.job = p.pool.apply_async(X.compress)
+			p.i += 1
+
+	def get(p, X):
+		"Returns the CFDATA of a folder, while the ones after it are compressed"
+		p.ahead(X.n + p.workers + 1)
+		return X.job.get()
+
+
+class FolderCache:
+# Keeps the CFDATA of compressed folders in a directory, by a digest of their
+# files and compression, so that rebuilding a cabinet from the same files doesn't
+# compress them again; least recently used folders go beyond limit bytes
+	def __init__(p, path, limit=1<<30):
+		p.path = path
+		p.limit = limit
+		p.hits, p.misses, p.stores, p.evictions = 0, 0, 0, 0
+		p.entries = None # name: (time last used, size), listed once
+		p.lru = [] # heap of (time, name): entries whose time changed since are stale
+		p.total = 0 # bytes in cache
+		p.pinned = set() # keys found in this build, not yet copied: never evicted
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+	def _name(p, key): return os.path.join(p.path, key + '.cfd')
+
+	def key(p, files, *how):
+		"Digest of the ordered files contents (a copy by its first one's index) and of how they're compressed"
+		h = hashlib.sha1(repr(how).encode())
+		seen = {}
+		for i, f in enumerate(files):
+			seen[id(f)] = i
+			if f._dup:
+				if id(f._dup[0]) not in seen:
+					return None # its data will be in another folder
+				h.update(b'A%d' % seen[id(f._dup[0])])
+				continue
+			d = FileDigest(f.path)
+			if d is None:
+				return None
+			h.update(b'D%d' % f.cbFile + d)
+		return h.hexdigest()
+
+	def find(p, key):
+		"Tells if a folder is in cache, and whole: it is pinned there till its CFDATA are read by blocks"
+		name = p._name(key)
+		pos, end = 0, -1
+		try:
+			f = open(name, 'rb')
+			try:
+				end = os.fstat(f.fileno()).st_size
+				# walks the CFDATA headers only: the data is read when copied
+				while pos + 4 <= end:
+					f.seek(pos)
+					size, n = struct.unpack('<2H', f.read(4))
+					pos += 4 + n
+			finally:
+				f.close()
+			os.utime(name, None) # recently used
+		except (IOError, OSError):
+			p.misses += 1
+			logging.debug('Folder %s not in cache', key)
+			return 0
+		if pos != end:
+			p.misses += 1
+			logging.debug('Folder %s corrupted in cache', key)
+			return 0
+		p.hits += 1
+		p.pinned.add(key)
+		p._used(key + '.cfd', end)
+		logging.debug('Folder %s found in cache, %d bytes', key, end)
+		return 1
+
+	def blocks(p, key):
+		"Yields the (uncompressed size, data) of each CFDATA of a folder found in cache, reading them one at a time"
+		f = open(p._name(key), 'rb')
+		try:
+			while 1:
+				s = f.read(4)
+				if len(s) < 4: break
+				size, n = struct.unpack('<2H', s)
+				yield size, f.read(n)
+		finally:
+			f.close()
+			p.pinned.discard(key)
+
+	def open(p):
+		"Returns a temporary file in the cache directory, to write the CFDATA of a folder to"
+		return tempfile.NamedTemporaryFile('wb', dir=p.path, suffix='.tmp', delete=False)
+
+	def write(p, f, size, s):
+		"Appends a CFDATA (its uncompressed size and data) to a file made by open"
+		f.write(struct.pack('<2H', size, len(s)))
+		f.write(s)
+
+	def discard(p, f):
+		"Removes a file made by open, whose folder won't be stored"
+		f.close()
+		os.remove(f.name)
+
+	def put(p, key, blocks):
+		"Stores the (uncompressed size, data) of each CFDATA of a folder, or a file made by open with them"
+		f = blocks
+		if isinstance(blocks, list):
+			f = p.open()
+			for size, s in blocks:
+				p.write(f, size, s)
+		f.close()
+		n = os.path.getsize(f.name)
+		try:
+			os.rename(f.name, p._name(key))
+		except OSError: # already there (Windows)
+			os.remove(f.name)
+		p.stores += 1
+		logging.debug('Folder %s stored in cache, %d bytes', key, n)
+		p._used(key + '.cfd', n)
+		p._evict()
+
+	def _list(p):
+		"Lists the folders in cache, the first time"
+		if p.entries is not None: return
+		p.entries = {}
+		for o in os.listdir(p.path):
+			if o.endswith('.cfd'):
+				st = os.stat(os.path.join(p.path, o))
+				p.entries[o] = (st.st_mtime, st.st_size)
+				p.total += st.st_size
+		p.lru = [(t, o) for o, (t, n) in p.entries.items()]
+		heapq.heapify(p.lru)
+
+	def _used(p, name, size):
+		"Records a folder in cache as the most recently used one"
+		p._list()
+		if name in p.entries:
+			p.total -= p.entries[name][1]
+		t = time.time()
+		p.entries[name] = (t, size)
+		p.total += size
+		heapq.heappush(p.lru, (t, name))
+
+	def _evict(p):
+		"Removes the least recently used folders, till the cache fits its limit"
+		p._list()
+		kept = []
+		while p.total > p.limit and p.lru:
+			t, o = heapq.heappop(p.lru)
+			if o not in p.entries or p.entries[o][0] != t:
+				continue # used again since
+			if o[:-4] in p.pinned:
+				kept += [(t, o)] # to copy in this build
+				continue
+			try:
+				os.remove(os.path.join(p.path, o))
+			except OSError:
+				pass
+			p.total -= p.entries.pop(o)[1]
+			p.evictions += 1
+			logging.debug('Folder %s evicted from cache', o)
+		for x in kept:
+			heapq.heappush(p.lru, x)
+
+	def Stats(p):
+		"Returns a tuple with hits, misses, folders stored and evicted"
+		return (p.hits, p.misses, p.stores, p.evictions)
 
 
-class CFFOLDER:
+class CFFOLDER(object):
 # Internal Cabinet Folder structure
+	__slots__ = ('coffCabStart', 'cCFData', 'typeCompress', 'Files', 'Size', 'abReserve', '_coffCabStart', '_sized')
+	S = struct.Struct('<L2H') # 8 bytes
+
 	def __init__(p):
-		p.format = '<L2H' # 8 bytes
 		p.coffCabStart = 0 # 1st CFDATA offset for this folder
 		p.cCFData = 0 # folder's CFDATA in this cabinet
 		p.typeCompress = 0 # 0=none 1="MS"-ZIP 2=QUANTUM 0xNN03=LZX with window size 2^NN
 		p.Files = []
 		p.Size = 0
-		p.abReserve = '' # not used (yet: why doesn't MS put an AES-key here...?)
+		p.abReserve = b'' # not used (yet: why doesn't MS put an AES-key here...?)
+		p._sized = (None, 0, 8) # Files list, items and bytes last measured by size()
 		
 	def size(p):
-		x = 8
-		for o in p.Files:
-			x += o.size()
+		"Returns the bytes of the folder and its items, measuring only the ones appended since last time"
+		L, n, x = p._sized
+		if L is not p.Files or n > len(L):
+			L, n, x = p.Files, 0, 8
+		for i in xrange(n, len(L)):
+			x += isinstance(L[i], bytes) and len(L[i]) or 17 + len(L[i].Name)
+		p._sized = (L, len(L), x)
 		return x
 		
-	def Read(p, fp):
-		s = fp.read(8)
-		s = struct.unpack(p.format,s)
-		(p.coffCabStart, p.cCFData, p.typeCompress) = s
-		logging.debug('Read CFFOLDER=%d, blocks=%d, comp=%d', p.coffCabStart, p.cCFData, p.typeCompress)
-			
 	def Write(p, fp):
-		if 1 < p.typeCompress < 10:
-			p.typeCompress = 1 # MSZIP Level to Flag
-		s = struct.pack(p.format, p.coffCabStart, p.cCFData, p.typeCompress)
-		fp.write(s)
+		t = p.typeCompress
+		if 1 < t < 10:
+			t = 1 # MSZIP Level to Flag (the level stays, for a continued folder)
+		fp.write(p.S.pack(p.coffCabStart, p.cCFData, t))
 
 
 class CFHEADER:
 # Initial Cabinet Header structure
+	S = struct.Struct('<4s5l2B5H')
+	RESERVE = struct.Struct('<1H2B')
+
 	def __init__(p):
-		p.format = '<4s5l2B5H' # 36 bytes
-		p.signature = 'MSCF'
+		p.signature = b'MSCF'
 		p.reserved1 = 0
 		p.cbCabinet = 0 # cabinet size
 		p.reserved2 = 0
@@ -563,13 +2515,14 @@ class CFHEADER:
 		p.cbCFHeader = 0 # optional size of per-cabinet reserved area (upto 60.000 bytes)
 		p.cbCFFolder = 0 # optional size of per-folder reserved area (upto 255 bytes)
 		p.cbCFData = 0 # optional size of per-datablock reserved area (upto 255 bytes)
-		p.abReserve = '' # per-cabinet reserved area
-		p.szCabinetPrev = '\x00' # max 255 bytes for all, plus NULL
-		p.szDiskPrev = '\x00'
-		p.szCabinetNext = '\x00'
-		p.szDiskNext = '\x00'
+		p.abReserve = b'' # per-cabinet reserved area
+		p.szCabinetPrev = b'\x00' # max 255 bytes for all, plus NULL
+		p.szDiskPrev = b'\x00'
+		p.szCabinetNext = b'\x00'
+		p.szDiskNext = b'\x00'
 		p.Folders = []
 		p.IO = 0
+		p.fp = 0 # file the header was read from
 		
 	def size(p): return p.size1() + p.size2()
 	
@@ -596,29 +2549,84 @@ class CFHEADER:
 			p.cFiles += len(fol.Files)
 			
 	def Read(p, fp):
+		"Reads the header with its folders in a single read, and all the items in another one"
 		s = fp.read(36)
-		s = struct.unpack(p.format,s)
+		if len(s) < 36:
+			raise CabArcException('Not a Cabinet file!')
 		(p.signature, p.reserved1, p.cbCabinet, p.reserved2, p.coffFiles, p.reserved3, p.versionMinor, p.versionMajor,
-		p.cFolders, p.cFiles, p.flags, p.setID, p.iCabinet) = s
-		assert (p.signature == 'MSCF')
+		p.cFolders, p.cFiles, p.flags, p.setID, p.iCabinet) = p.S.unpack(s)
+		if p.signature != b'MSCF':
+			raise CabArcException('Not a Cabinet file!')
 		logging.debug('Read CFHEADER=%d bytes, off=%d', p.cbCabinet, p.coffFiles)
+		if p.coffFiles < 36 or p.cFiles and not p.cFolders:
+			raise CabArcException('Bad Cabinet header!')
+		s = fp.read(p.coffFiles - 36) # reserved area, set names and CFFOLDERs
+		if len(s) < p.coffFiles - 36 or p.flags & 0x4 and len(s) < 4:
+			raise CabArcException('Truncated Cabinet header!')
+		i = 0
+		if p.flags & 0x4:
+			p.cbCFHeader, p.cbCFFolder, p.cbCFData = p.RESERVE.unpack_from(s)
+			p.abReserve = s[4:4+p.cbCFHeader]
+			i = 4 + p.cbCFHeader
+		L = []
+		for n in xrange(((p.flags & 0x1) + (p.flags >> 1 & 0x1)) << 1):
+			j = s.find(b'\x00', i) + 1
+			if not j:
+				raise CabArcException('Bad Cabinet header!')
+			L += [s[i:j]] # with the NULL
+			i = j
+		if p.flags & 0x1:
+			p.szCabinetPrev, p.szDiskPrev = L[:2]
+		if p.flags & 0x2:
+			p.szCabinetNext, p.szDiskNext = L[-2:]
+		if i + p.cFolders * (8 + p.cbCFFolder) > len(s):
+			raise CabArcException('Bad Cabinet header!')
+		unpack = CFFOLDER.S.unpack_from
 		for n in xrange(p.cFolders):
 			cf = CFFOLDER()
-			cf.Read(fp)
+			cf.coffCabStart, cf.cCFData, cf.typeCompress = unpack(s, i)
+			cf.abReserve = s[i+8:i+8+p.cbCFFolder]
+			i += 8 + p.cbCFFolder
 			p.Folders += [cf]
+		# the CFFILE table ends where the first CFDATA begins
+		end = [f.coffCabStart for f in p.Folders if f.cCFData and f.coffCabStart > p.coffFiles]
+		end = end and min(end) or p.cbCabinet
+		if end < p.coffFiles:
+			raise CabArcException('Bad Cabinet header!')
+		fp.seek(p.coffFiles)
+		s = fp.read(end - p.coffFiles)
+		i = 0
+		unpack, find, Folders = CFFILE.S.unpack_from, s.find, p.Folders
 		for n in xrange(p.cFiles):
 			cf = CFFILE()
-			cf.Read(fp)
-			p.Folders[cf.iFolder].Files += [cf]
+			(cf.cbFile, cf.uoffFolderStart, cf.iFolder, cf.date, cf.time, cf.attrs) = unpack(s, i)
+			j = find(b'\x00', i + 16)
+			while j < 0: # a bad table end: reads on
+				more = fp.read(65536)
+				if not more:
+					raise CabArcException('Truncated CFFILE table!')
+				s += more
+				find = s.find
+				j = find(b'\x00', i + 16)
+			cf.Name = s[i+16:j] # decoded by text(), when needed
+			i = j + 1
+			k = cf.iFolder
+			if k in (0xFFFD, 0xFFFF): # continued from previous cabinet
+				k = 0
+			elif k == 0xFFFE: # continued in next cabinet
+				k = -1
+			elif k >= len(Folders):
+				raise CabArcException('Bad folder index in CFFILE table!')
+			Folders[k].Files.append(cf)
 			
 	def Write(p, fp, again=0):
 		p._adjust()
 		fp.seek(0)
-		s = struct.pack(p.format,p.signature, p.reserved1, p.cbCabinet, p.reserved2, p.coffFiles, p.reserved3,
+		s = p.S.pack(p.signature, p.reserved1, p.cbCabinet, p.reserved2, p.coffFiles, p.reserved3,
 		p.versionMinor, p.versionMajor, p.cFolders, p.cFiles, p.flags, p.setID, p.iCabinet)
 		fp.write(s)
 		if p.flags & 0x4:
-			s = struct.pack('<1H2B',p.cbCFHeader,p.cbCFFolder,p.cbCFData)
+			s = p.RESERVE.pack(p.cbCFHeader,p.cbCFFolder,p.cbCFData)
 			fp.write(s)
 			fp.write(p.abReserve)
 		if p.flags & 0x1:
@@ -628,36 +2636,179 @@ class CFHEADER:
 		for o in p.Folders:
 			o.Write(fp)
 		p.coffFiles = fp.tell()
+		size, pack = p.size(), CFFILE.S.pack
 		for o in p.Folders:
-			o.coffCabStart = o._coffCabStart + p.size()
-			for o1 in o.Files:
-				o1.Write(fp)
+			o.coffCabStart = o._coffCabStart + size
+			# items are packed in chunks, not written one by one
+			L = o.Files
+			for i in xrange(0, len(L), 4096):
+				fp.write(b''.join([isinstance(f, bytes) and f or pack(f.cbFile, f.uoffFolderStart, f.iFolder, f.date, f.time, f.attrs) + f.Name + b'\x00' for f in L[i:i+4096]]))
 		if not again:
 			p.Write(fp,1) # rewrites with updated coffFiles
 
 
+class CFDATAIndex:
+# Maps the uncompressed ranges of a folder to its CFDATA, saving the 32 KiB history
+# needed to resume inflating every step blocks (a folder of 1..n cabinets)
+	def __init__(p, step=1):
+		p.step = step
+		p.uoff = [] # uncompressed offset of each block
+		p.size = [] # uncompressed size of each block
+		p.parts = [] # [(cabinet #, CFDATA offset), ...] for each block
+		p.hist = {} # block # -> history
+
+	def add(p, size, parts):
+		p.uoff += [p.uoff and p.uoff[-1] + p.size[-1] or 0]
+		p.size += [size]
+		p.parts += [parts]
+
+	def find(p, pos):
+		"Returns the block containing an uncompressed offset"
+		return max(bisect.bisect_right(p.uoff, pos) - 1, 0)
+
+	def start(p, pos):
+		"Returns the nearest block before pos, whose history is known"
+		i = p.find(pos)
+		return i - i % p.step
+
+	def Read(p, fp):
+		n, p.step = struct.unpack('<2L', fp.read(8))
+		for i in xrange(n):
+			uoff, size, k = struct.unpack('<QHB', fp.read(11))
+			L = []
+			for j in xrange(k):
+				L += [struct.unpack('<HL', fp.read(6))]
+			p.uoff += [uoff]
+			p.size += [size]
+			p.parts += [L]
+		for k in xrange(struct.unpack('<L', fp.read(4))[0]):
+			i, n = struct.unpack('<2L', fp.read(8))
+			p.hist[i] = zlib.decompress(fp.read(n))
+
+	def Write(p, fp):
+		fp.write(struct.pack('<2L', len(p.size), p.step))
+		for i in xrange(len(p.size)):
+			fp.write(struct.pack('<QHB', p.uoff[i], p.size[i], len(p.parts[i])))
+			for n, pos in p.parts[i]:
+				fp.write(struct.pack('<HL', n, pos))
+		fp.write(struct.pack('<L', len(p.hist)))
+		for i in sorted(p.hist):
+			s = zlib.compress(p.hist[i])
+			fp.write(struct.pack('<2L', i, len(s)))
+			fp.write(s)
+
+
+class FolderReader:
+# Reads the uncompressed stream of a folder sequentially, one block at a time
+	def __init__(p, cab, index):
+		p.C = cab
+		p.index = index # logical folder
+		p.blocks = cab._inflate(index)
+		p.buf = b'' # current uncompressed block
+		p.ofs = 0 # read offset in buf
+		p.pos = 0 # folder offset of buf[ofs]
+
+	def seek(p, pos):
+		X = p.C.blockindex and p.C.blockindex[p.index]
+		if X and (pos < p.pos or pos - p.pos > X.step * 32768):
+			i = X.start(pos) # jumps to the nearest block we can inflate from
+			p.blocks = p.C._inflate(p.index, i)
+			p.buf, p.ofs, p.pos = b'', 0, X.uoff[i]
+		elif pos < p.pos:
+			p.__init__(p.C, p.index) # restarts from folder's beginning
+		while p.pos < pos:
+			if not p.read(min(pos - p.pos, 32768)):
+				break
+
+	def read(p, n):
+		L = []
+		while n > 0:
+			if p.ofs == len(p.buf):
+				try:
+					p.buf = next(p.blocks)
+				except StopIteration:
+					break
+				p.ofs = 0
+			s = p.buf[p.ofs:p.ofs+n]
+			p.ofs += len(s)
+			p.pos += len(s)
+			n -= len(s)
+			L += [s]
+		return b''.join(L)
+
+
+class CabItem:
+# Read-only file-like object streaming an item from its folder
+	def __init__(p, cab, item, reader=None):
+		p.item = item # CFFILE
+		p.reader = reader or FolderReader(cab, item._folder)
+		p.left = item.cbFile
+		p.started = 0
+
+	def read(p, n=-1):
+		if not p.started:
+			p.reader.seek(p.item.uoffFolderStart)
+			p.started = 1
+		if n < 0 or n > p.left:
+			n = p.left
+		s = p.reader.read(n)
+		if len(s) < n:
+			raise CabArcException("Item '%s' is truncated!" % p.item.text())
+		p.left -= n
+		return s
+
+	def close(p):
+		p.left = 0
+
+	def __enter__(p): return p
+
+	def __exit__(p, *args): p.close()
+
+
 class Cabinet:
 # Class to manage a single Cabinet, or a set
-	def __init__(p, name, mode, limit=2**32, compression=0):
+	def __init__(p, name, mode, limit=2**32, compression=None, workers=1, depth=0, readahead=0, strategy='strict'):
 		p.Index = 0 # set index
 		p.destname = name # cabinet name or cabinet set root name
 		p.lastname = p._name(name) # file to write to
 		p.label = '' # disk label for a set
 		p.reserved = 0 # per-header reserved space
+		p.route = 0 # store incompressible files in a folder of their own
+		p.base = 0 # Cabinet (read) whose unchanged folders are copied, updating it
+		p.dedup = 0 # list files with the same contents of a previous one at its offset
+		p._bysize = {} # size: [[CFFILE, digest, first copy]] of the files queued
+		p.cache = 0 # FolderCache, to reuse compressed folders across builds
+		p.compression = 6 if compression is None else compression # type of the folders added without one
+		p.autotune = 0 # MB/s the MSZIP folders should be compressed at (their level is picked by a trial)...
+		p.budget = 0 # ...or seconds to compress them all in
+		p.folderworkers = 0 # threads compressing whole folders at a time (0 = none)
+		p.foldersize = 0 # start a new folder when files exceed these bytes...
+		p.folderfiles = 0 # ...or count
+		p._type = 0 # type of the last folder added
+		p._size, p._count = 0, 0 # bytes and files in it
+		p._stored = [] # incompressible files routed out of the last folder
 		p.limit = limit # CAB unit max size - default: 4 GiB (required to let other things work properly)
 		p.ch = [] # cabinet headers
-		p.IO = IOStream(p, compression) # I/O stuff helper
-		p.idict = idict() # CFFILEs dictionary
+		p.metrics = NoMetrics() # a Metrics records time and bytes of each stage of Flush
+		p.progress = None # callback(files, total files, bytes, total bytes) as files are written
+		p.IO = IOStream(p, compression, workers, depth, readahead, strategy) # I/O stuff helper
+		p.idict = Catalog() # CFFILEs read, by name (filled at the first lookup)
+		p.files = [] # CFFILEs read, in cabinet order
+		p.added = 0 # items queued to write (they aren't kept by name)
+		p.blockindex = [] # CFDATAIndex for each folder (None for an LZX one), if built or loaded
 		if limit < 50000:
-			raise 'CabArcException', 'Microsoft wants a cabinet unit size greater than 50.000 bytes!'
+			raise CabArcException('Microsoft wants a cabinet unit size greater than 50.000 bytes!')
 		if mode == 'r':
-			p.f = file(name,mode+'b')
-			p.AddHeader()
+			p.f = open(name,mode+'b')
+			p.ch += [CFHEADER()]
 			p.ch[-1].Read(p.f)
+			p.ch[-1].fp = p.f
+			p._readset()
+			p.LoadIndex()
 		elif mode == 'w':
 			pass # eh! eh! eh!
 		else:
-			raise 'CabArcException', "You MUST specify 'r' or 'w' as Cabinet open mode!"
+			raise CabArcException("You MUST specify 'r' or 'w' as Cabinet open mode!")
 			
 	def _name(p, s, type=1):
 		"Generates a disk (or label) name for current (default), previous or next cabinet unit"
@@ -667,14 +2818,14 @@ class Cabinet:
 		s = s.replace('#',str(i))
 		return s
 		
-	def _additem(p, itemname, pathname, dt=None):
-		"Adds a disk file to the last folder with the specified internal name (and date)"
+	def _additem(p, itemname, pathname, ds=None):
+		"Adds a disk file to the last folder with the specified internal name (and DosStat)"
 		if not p.ch:
-			raise 'CabArcException', 'You MUST add a Cabinet header before adding folders!'
+			raise CabArcException('You MUST add a Cabinet header before adding folders!')
 		if not p.ch[-1].Folders:
-			raise 'CabArcException', 'You MUST add a Cabinet folder before adding files!'
+			raise CabArcException('You MUST add a Cabinet folder before adding files!')
 		if not p.IO:
-			raise 'CabArcException', "You CAN'T add files to a closed Cabinet!"
+			raise CabArcException("You CAN'T add files to a closed Cabinet!")
 		#~ if itemname in p.idict:
 			#~ info("WARNING: skipping '%s' because it is already archived!" % itemname)
 			#~ return
@@ -682,27 +2833,492 @@ class Cabinet:
 		f.path = pathname
 		f.Name = itemname
 		try:
-			f.Name.encode('cp850')
+			if not isinstance(f.Name, bytes): # a bytes name is stored as is
+				f.Name = f.Name.encode('cp850')
 		except UnicodeEncodeError:
-			f.Name = f.Name.encode('utf8')
-			f.attrs |= 0x80
+			try:
+				f.Name = f.Name.encode('utf8')
+				f.attrs |= 0x80
+			except UnicodeEncodeError:
+				# a file name not in the file system encoding (Python 3 escapes
+				# its bytes as surrogates): its bytes are stored as they are
+				f.Name = fsbytes(f.Name)
 		if len(f.Name) > 255: # with UTF-8, too?
 			info("WARNING: '%s' item name > 255 chars, skipped!" % itemname)
 			return
-		if not os.access(pathname,os.W_OK):
-			f.attrs |= 0x1
-		if sys.platform in ('win32', 'cygwin'):
-			attrs = windll.kernel32.GetFileAttributesA(pathname)
-			if attrs & 0x2: f.attrs |= 0x2
-			if attrs & 0x4: f.attrs |= 0x4
-			if attrs & 0x20: f.attrs |= 0x20
-			logging.debug('Extracted DOS perms: %08X', f.attrs)
+		try:
+			f._adjust(ds)
+		except OSError:
+			info('WARNING! file %s skipped!'%(pathname))
+			return
+		p.added += 1
+		if p.dedup:
+			f._dup = p._duplicate(f)
+		if f._dup:
+			# no data: the copy goes where the first one does
+			if f._dup[0] in p._stored:
+				p._stored += [f]
+			else:
+				p.IO.push(f)
+			return
+		if p.route and p._type and not IsCompressible(pathname):
+			logging.debug('Routed incompressible file %s', pathname)
+			p._stored += [f] # queued after the folder's files, see _pushstored
+			return
+		if p._overflows(p._size, p._count, f):
+			logging.debug('Folder full with %d files, %d bytes', p._count, p._size)
+			p.IO.push(p._type) # a new folder of the same type
+			p._size, p._count = 0, 0
 		logging.debug('Pushed file %s', pathname)
-		p.idict[itemname] = f
-		p.IO.push(f)
-		p.IO.flush()
+		p.IO.push(f, not p.dedup) # data will be written by Flush
+		p._size += f.cbFile
+		p._count += 1
+
+	def _duplicate(p, f):
+		"Returns [CFFILE] queued before with the same contents of f, if any"
+		# files are hashed only if another one has the same size
+		if not f.cbFile:
+			return None
+		L = p._bysize.setdefault(f.cbFile, [])
+		d = None
+		if L:
+			d = FileDigest(f.path)
+			for x in L:
+				if x[1] is None:
+					x[1] = FileDigest(x[0].path)
+				if d and x[1] == d:
+					logging.debug('File %s has the contents of %s', f.path, x[0].path)
+					return x[2]
+		L += [[f, d, [f]]]
+		return None
+
+	def _overflows(p, size, count, f):
+		"Tells if a folder holding count files (size bytes) can't take f, too"
+		if not count:
+			return 0 # a big file gets a folder anyway
+		if p.folderfiles and count >= p.folderfiles:
+			return 1
+		return size + f.cbFile > min(p.foldersize or MAXFOLDER, MAXFOLDER)
+
+	def _reuse(p):
+		"Queues copies of the base folders whose files are all queued unchanged, in place of them"
+		kind = lambda t: 1 < t < 10 and 1 or t # MSZIP level isn't recorded
+		Q = p.IO._files
+		t = p.ch[-1].Folders[-1].typeCompress
+		first, queued = t, {}
+		for o in Q:
+			if isinstance(o, CFFILE):
+				queued[p.idict._norm(o.text())] = (o, kind(t))
+			elif not isinstance(o, FolderCopy): # a copy keeps the type of its source
+				t = o
+		B = p.base
+		L = [[] for x in B.folders]
+		for x in B.files:
+			L[x._folder] += [x]
+		copies, reused = [], set()
+		for i, files in enumerate(L):
+			new = [queued.get(p.idict._norm(x.text())) for x in files]
+			if not files or None in new:
+				continue
+			t = kind(B.folders[i][0][1].typeCompress)
+			if [x for x, (y, u) in zip(files, new) if (x.cbFile, x.date, x.time, t) != (y.cbFile, y.date, y.time, u)]:
+				continue
+			for x, (y, u) in zip(files, new):
+				reused.add(id(y))
+				y.uoffFolderStart = x.uoffFolderStart
+			copies += [FolderCopy(B, i, [y for y, u in new])]
+		if not copies:
+			return
+		logging.debug('Reusing %d folders of %s', len(copies), B.destname)
+		p.IO._files = collections.deque(copies + [first] + [o for o in Q if id(o) not in reused])
+
+	def _cached(p):
+		"Queues copies of the folders found in cache in place of their files, marks the others to be cached"
+		Q, R = list(p.IO._files), []
+		t = p.ch[-1].Folders[-1].typeCompress
+		i = 0
+		while i < len(Q):
+			if not isinstance(Q[i], CFFILE):
+				if not isinstance(Q[i], FolderCopy):
+					t = Q[i]
+				R += [Q[i]]
+				i += 1
+				continue
+			j = i
+			while j < len(Q) and isinstance(Q[j], CFFILE):
+				j += 1
+			G = Q[i:j]
+			i = j
+			C = p.IO._compressor(t)
+			key = t and p.cache.key(G, t, C.level, getattr(C, 'strategy', '')) # stored folders aren't worth it
+			if not key:
+				R += G
+				continue
+			if not p.cache.find(key):
+				G[0]._cache = (key, G[-1])
+				R += G
+				continue
+			u = 0
+			for f in G:
+				if f._dup:
+					f.uoffFolderStart = f._dup[0].uoffFolderStart
+				else:
+					f.uoffFolderStart = u
+					u += f.cbFile
+			R += [CachedFolder(p.cache, t, G, key)]
+		p.IO._files = collections.deque(R)
+
+	def _pooled(p):
+		"Queues the MSZIP folders made only of files to be compressed by a FolderPool, in place of their files"
+		Q, R, G = p.IO._files, [], []
+		t = p.ch[-1].Folders[-1].typeCompress
+		for o in list(Q) + [None]:
+			if isinstance(o, CFFILE):
+				G += [o]
+				continue
+			ids = set([id(f) for f in G])
+			C = t and p.IO._compressor(t)
+			if isinstance(C, MSZIP) and G and not [f for f in G if f._dup and id(f._dup[0]) not in ids]:
+				# files sharing data with other folders are left to IOStream
+				if not p.IO.fpool:
+					p.IO.fpool = FolderPool(p.folderworkers)
+				X = PooledFolder(p.IO.fpool, p, t, G, (C.level, C.mem, C.strategy), G[0]._cache and G[0]._cache[0])
+				p.IO.fpool.add(X)
+				G = [X]
+			R += G
+			G = []
+			if o is not None and not isinstance(o, FolderCopy):
+				t = o
+			R += o is not None and [o] or []
+		if p.IO.fpool and len(p.IO.fpool.folders) > 1:
+			p.IO._files = collections.deque(R)
+			p.IO.fpool.ahead(p.IO.fpool.workers)
+		elif p.IO.fpool: # a single folder gains nothing
+			p.IO.fpool.pool.close()
+			p.IO.fpool = 0
+
+	def _autotune(p):
+		"Sets the MSZIP level of each folder by a trial compression of its first blocks"
+		Q = p.IO._files
+		marks, types, groups = [-1], [p.ch[-1].Folders[-1].typeCompress], [[]] # -1 is the actual folder
+		for i, o in enumerate(Q):
+			if isinstance(o, CFFILE):
+				groups[-1] += [o]
+			elif not isinstance(o, FolderCopy):
+				marks += [i]
+				types += [o]
+				groups += [[]]
+		mbps = p.autotune
+		if p.budget:
+			total = sum([f.cbFile for t, G in zip(types, groups) if 0 < t < 10 for f in G if not f._dup])
+			mbps = total / float(1<<20) / p.budget
+		for i, t, G in zip(marks, types, groups):
+			if not 0 < t < 10:
+				continue
+			blocks = FolderSample([f for f in G if not f._dup])
+			if len(blocks) < 2:
+				continue # a trial would cost more than it saves
+			t = TuneLevel(blocks, mbps, p.IO.strategy)
+			if i < 0:
+				p.ch[-1].Folders[-1].typeCompress = t
+			else:
+				Q[i] = t
+
+	def _pushstored(p):
+		"Queues the incompressible files of the last folder in uncompressed ones"
+		size, count = 0, 0
+		for f in p._stored:
+			if not count or p._overflows(size, count, f):
+				p.IO.push(0)
+				size, count = 0, 0
+			p.IO.push(f, not p.dedup)
+			size += f.cbFile
+			count += 1
+		p._stored = []
+
+	def _readset(p):
+		"Opens the next cabinets in a set, and joins the folders they continue"
+		p.folders = [] # logical folders, as lists of (CFHEADER, CFFOLDER)
+		p.files = [] # CFFILEs (an item continued across cabinets is listed once)
+		while 1:
+			P = p.ch[-1]
+			for i, fol in enumerate(P.Folders):
+				if i == 0 and len(p.ch) > 1 and \
+				  [x for x in fol.Files if x.iFolder in (0xFFFD, 0xFFFF)]:
+					p.folders[-1] += [(P, fol)]
+				else:
+					p.folders += [[(P, fol)]]
+				for x in fol.Files:
+					if x.iFolder in (0xFFFD, 0xFFFF):
+						continue # listed in the previous cabinet
+					x._folder = len(p.folders) - 1
+					p.files += [x]
+			if not P.flags & 0x2:
+				break
+			name = os.path.join(os.path.dirname(p.destname), fstext(P.szCabinetNext.rstrip(b'\x00')))
+			if not os.path.exists(name):
+				logging.debug('Next cabinet %s not found', name)
+				break
+			h = CFHEADER()
+			h.fp = open(name,'rb')
+			h.Read(h.fp)
+			p.ch += [h]
+
+	def _fp(p, n, fps=None):
+		"Returns the file of cabinet n: the shared one, or a private one kept in fps (by a worker thread)"
+		if fps is None:
+			return p.ch[n].fp
+		if n not in fps:
+			fps[n] = open(p.ch[n].fp.name, 'rb')
+		return fps[n]
+
+	def _blocks(p, index, start=0, fps=None, check=0):
+		"Yields the CFDATA of a logical folder, joining those split across cabinets"
+		X = p.blockindex and p.blockindex[index]
+		if X:
+			# the CFDATA positions are known: jumps to the start block
+			for i in xrange(start, len(X.size)):
+				s = b''
+				for n, pos in X.parts[i]:
+					fp = p._fp(n, fps)
+					fp.seek(pos)
+					c = CFDATA()
+					c.Read(fp, 1, p.ch[n].cbCFData)
+					if check and not c.check():
+						raise CabArcException('Bad checksum of CFDATA @0x%08X in %s!' % (pos, fp.name))
+					s += c.data
+				yield X.size[i], s, X.parts[i]
+			return
+		part, parts = b'', []
+		for h, fol in p.folders[index]:
+			pos = fol.coffCabStart
+			k = p.ch.index(h)
+			fp = p._fp(k, fps)
+			for n in xrange(fol.cCFData):
+				fp.seek(pos)
+				c = CFDATA()
+				c.Read(fp, 1, h.cbCFData)
+				if check and not c.check():
+					raise CabArcException('Bad checksum of CFDATA @0x%08X in %s!' % (pos, fp.name))
+				parts += [(k, pos)]
+				pos = fp.tell()
+				if not c.cbUncomp: # continues in the next cabinet
+					part += c.data
+					continue
+				yield c.cbUncomp, part + c.data, parts
+				part, parts = b'', []
+
+	def _inflate(p, index, start=0, fps=None, check=0):
+		"Yields the uncompressed blocks of a logical folder (from a start block)"
+		t = p.folders[index][0][1].typeCompress
+		if t & 0xF == 1:
+			D = UnMSZIP()
+			if start:
+				D.hist = p.blockindex[index].hist[start]
+		elif t & 0xF == 3:
+			D = UnLZX(t >> 8 & 0x1F) # an LZX folder is always read from its start
+		elif t & 0xF:
+			raise CabArcException('Compression type 0x%04X is not supported!' % t)
+		for size, s, parts in p._blocks(index, start, fps, check):
+			if t:
+				s = D.decompress(s, size)
+			if len(s) != size:
+				raise CabArcException('Bad CFDATA in folder #%d!' % index)
+			yield s
+
+	def BuildIndex(p, step=16):
+		"Scans all folders, mapping uncompressed ranges to CFDATA and saving the history every step blocks"
+		p.blockindex = [] # free the old one, so that _blocks really scans
+		L = []
+		for i in xrange(len(p.folders)):
+			t = p.folders[i][0][1].typeCompress
+			if t & 0xF not in (0, 1):
+				L += [None] # no history to save: an LZX folder is read from its start
+				continue
+			X = CFDATAIndex(t and step or 1)
+			D = UnMSZIP()
+			for size, s, parts in p._blocks(i):
+				n = len(X.size)
+				if t and n and not n % X.step:
+					X.hist[n] = D.hist
+				X.add(size, parts)
+				if t:
+					D.decompress(s)
+			L += [X]
+		p.blockindex = L
+
+	def SaveIndex(p, name=''):
+		"Saves the CFDATA index in a sidecar file (default: cabinet name + .idx)"
+		f = open(name or p.destname+'.idx', 'wb')
+		f.write(struct.pack('<4sHLHL', b'PCAI', 1, p.ch[0].cbCabinet, p.ch[0].setID, len(p.blockindex)))
+		for X in p.blockindex:
+			(X or CFDATAIndex()).Write(f)
+		f.close()
+
+	def LoadIndex(p, name=''):
+		"Loads the CFDATA index from a sidecar file, if it matches the cabinet"
+		name = name or p.destname+'.idx'
+		if not os.path.exists(name):
+			return 0
+		f = open(name, 'rb')
+		sig, ver, cb, setID, n = struct.unpack('<4sHLHL', f.read(16))
+		if sig != b'PCAI' or ver != 1 or cb != p.ch[0].cbCabinet or \
+		  setID != p.ch[0].setID or n != len(p.folders):
+			logging.debug('Index %s does not match the cabinet: ignored', name)
+			f.close()
+			return 0
+		L = []
+		for i in xrange(n):
+			X = CFDATAIndex()
+			X.Read(f)
+			L += [X.size and X or None] # a folder not indexed is saved empty
+		f.close()
+		p.blockindex = L
+		return 1
+
+	def _catalog(p):
+		"Returns the catalog of the items read, hashing their names the first time"
+		if p.files and not p.idict:
+			for x in p.files:
+				p.idict[x.text()] = x
+		return p.idict
+
+	def _getitem(p, name):
+		p._catalog()
+		try:
+			return p.idict[name]
+		except KeyError:
+			raise CabArcException("There is no item named '%s' in the Cabinet!" % name)
+
+	def _target(p, item, path):
+		"Returns the pathname of an item extracted below path, making its directories"
+		L = [x for x in item.text().split('\\') if x not in ('', '.', '..') and ':' not in x]
+		dst = os.path.join(path, *L)
+		if os.path.dirname(dst) and not os.path.isdir(os.path.dirname(dst)):
+			try:
+				os.makedirs(os.path.dirname(dst))
+			except OSError: # made by another thread, meanwhile
+				if not os.path.isdir(os.path.dirname(dst)): raise
+		return dst
+
+	def _extract(p, item, path, reader=None):
+		"Extracts an item below path, returning its pathname"
+		dst = p._target(item, path)
+		src = CabItem(p, item, reader)
+		fo = open(dst, 'wb')
+		while 1:
+			s = src.read(65536)
+			if not s: break
+			fo.write(s)
+		fo.close()
+		item._restore(dst)
+		return dst
+
+	def _create(p, item, path):
+		"Opens the file an item is extracted to, preallocating its size (None when testing)"
+		if path is None:
+			return None
+		fo = open(p._target(item, path), 'wb')
+		if item.cbFile:
+			try:
+				os.posix_fallocate(fo.fileno(), 0, item.cbFile)
+			except (AttributeError, OSError): # Python 2, Windows or a file system without it
+				fo.truncate(item.cbFile)
+		return fo
+
+	def _unpack(p, index, files, path):
+		"Inflates a logical folder once, verifying its CFDATA and streaming its files below path (or nowhere, if None)"
+		files = sorted(files, key=lambda x: x.uoffFolderStart)
+		fps = {} # a worker thread reads the cabinets through its own files
+		out = [] # [CFFILE, file object] being written
+		k, pos = 0, 0
+
+		def done(f, fo):
+			if f.uoffFolderStart + f.cbFile > pos:
+				raise CabArcException("Item '%s' is truncated!" % f.text())
+			if fo:
+				fo.close()
+				f._restore(fo.name)
+				info('  extracting: '+f.text())
+
+		try:
+			for s in p._inflate(index, 0, fps, 1):
+				end = pos + len(s)
+				while k < len(files) and files[k].uoffFolderStart < end:
+					out += [[files[k], p._create(files[k], path)]]
+					k += 1
+				for f, fo in out:
+					a, b = max(f.uoffFolderStart, pos), min(f.uoffFolderStart + f.cbFile, end)
+					if fo and a < b:
+						fo.write(buffer(s, a - pos, b - a))
+				pos = end
+				L = []
+				for o in out:
+					if o[0].uoffFolderStart + o[0].cbFile > pos:
+						L += [o]
+					else:
+						done(*o)
+				out = L
+			while k < len(files): # empty items, at the end of the folder
+				out += [[files[k], p._create(files[k], path)]]
+				k += 1
+			for f, fo in out:
+				done(f, fo)
+			out = []
+		finally:
+			for f, fo in out:
+				if fo: fo.close()
+			for fp in fps.values():
+				fp.close()
+		return pos
+
+	def _unpackall(p, path, workers):
+		"Unpacks (or tests) all the logical folders, biggest first, on a pool of threads"
+		G = {}
+		for x in p.files:
+			G.setdefault(x._folder, []).append(x)
+		for i in xrange(len(p.folders)):
+			G.setdefault(i, []) # a folder holding only continued items is tested, too
+		order = sorted(G, key=lambda i: -sum([f.cCFData for h, f in p.folders[i]]))
+		pool = ThreadPool(workers or cpu_count())
+		try:
+			jobs = [(i, pool.apply_async(p._unpack, (i, G[i], path))) for i in order]
+			for i, job in jobs:
+				yield i, job
+		finally:
+			pool.close()
+			pool.join()
 
 # High-level, quasi-external functions
+	def namelist(p, pattern=''):
+		"Returns the names of the items in the cabinet (or set), or those matching pattern"
+		if pattern:
+			return p._catalog().match(pattern)
+		return [x.text() for x in p.files]
+
+	def open(p, name):
+		"Returns a file-like object to read an item from the cabinet"
+		return CabItem(p, p._getitem(name))
+
+	def extract(p, name, path=''):
+		"Extracts an item below path (default: current directory)"
+		return p._extract(p._getitem(name), path)
+
+	def extractall(p, path='', workers=0):
+		"Extracts all items below path, inflating each folder once and up to workers (0 = one per CPU) at a time"
+		for i, job in p._unpackall(path, workers):
+			job.get()
+
+	def testall(p, workers=0):
+		"Verifies the CFDATA checksums and inflates all folders, like extractall, returning the errors found"
+		L = []
+		for i, job in p._unpackall(None, workers):
+			try:
+				job.get()
+			except (CabArcException, zlib.error, IOError, struct.error) as e:
+				L += ['Folder #%d: %s' % (i, e)]
+		return L
+
 	def AddHeader(p):
 		"Adds an header to current cabinet. One header IS REQUIRED to add folders!"
 		p.Index += 1
@@ -713,38 +3329,45 @@ class Cabinet:
 		if p.reserved:
 			P.flags |= 0x4
 			P.cbCFHeader = p.reserved
-			P.abReserve = P.cbCFHeader * '\x00'
+			P.abReserve = P.cbCFHeader * b'\x00'
 		if p.limit:
 			dn = os.path.split(p.destname)[1]
 			P.cbCabinet = p.limit
 			P.flags |= 0x2
-			P.szCabinetNext = p._name(dn,2)+'\x00'
+			P.szCabinetNext = fsbytes(p._name(dn,2))+b'\x00'
 			if p.label:
-				P.szDiskNext = p._name(p.label,2)+'\x00'
+				P.szDiskNext = fsbytes(p._name(p.label,2))+b'\x00'
 			if len(p.ch) > 1:
 				P.flags |= 0x1
 				P.setID = p.ch[-2].setID
 				P.iCabinet = p.ch[-2].iCabinet + 1
-				P.szCabinetPrev = p._name(dn,0)+'\x00'
+				P.szCabinetPrev = fsbytes(p._name(dn,0))+b'\x00'
 				if p.label:
-					P.szDiskPrev = p._name(p.label,0)+'\x00'
+					P.szDiskPrev = fsbytes(p._name(p.label,0))+b'\x00'
 
 	def _addfolder(p, type=1):
 		f = CFFOLDER()
-		f._coffCabStart = p.IO.fout[-1].tell() # relative offset
+		f._coffCabStart = p.IO._datapos() # relative offset
 		f.typeCompress = type
 		p.ch[-1].Folders += [f]
 		p.ch[-1].cFolders += 1
 
-	def AddFolder(p, type=1):
+	def AddFolder(p, type=None):
 		"Adds a folder to the cabinet. At least 1 folder IS REQUIRED to add files!"
 		if not p.ch:
-			raise 'CabArcException', 'You MUST add a Cabinet header before adding folders!'
-		if p.ch[-1].Folders:
-			p.IO.flush(1) # flush any previous open folder
+			raise CabArcException('You MUST add a Cabinet header before adding folders!')
 		# Type may be: 0 (uncompressed), 1..9 (MSZIP with level 1..9),
-		# 0x0F03..0x1503 (LZX with dictionary 15..21)
-		p._addfolder(type)
+		# 0x0F03..0x1503 (LZX with dictionary 15..21); each one gets its
+		# own compressor (see NewCompressor); default is the Cabinet's one
+		if type is None:
+			type = p.compression
+		if p.ch[-1].Folders:
+			p._pushstored()
+			p.IO.push(type) # previous folder is closed after its files are written
+		else:
+			p._addfolder(type)
+		p._type = type
+		p._size, p._count = 0, 0
 
 	def Add(p, name, strip=''):
 		"Adds a disk file to the last folder"
@@ -760,18 +3383,73 @@ class Cabinet:
 		for o in glob.glob(name):
 			p._additem(Disk2CabName(o,strip),o)
 
+	def AddTree(p, top, strip='', workers=8):
+		"Adds all the files below a directory to the last folder"
+		for o, ds in ScanTree(top, workers):
+			p._additem(Disk2CabName(o,strip),o,ds)
+
+	def AddCabinet(p, cab):
+		"Queues all the folders of a cabinet (or set) being read, to copy them without recompression"
+		if not p.ch or not p.ch[-1].Folders:
+			raise CabArcException('You MUST add a Cabinet header and folder before adding cabinets!')
+		p._pushstored()
+		L = [[] for x in cab.folders]
+		for x in cab.files:
+			y = copy.copy(x) # same offset in the same (copied) folder
+			L[x._folder] += [y]
+			p.added += 1
+		for i, files in enumerate(L):
+			p.IO.push(FolderCopy(cab, i, files))
+		p.IO.push(p._type) # files added later go to a new folder
+		p._size, p._count = 0, 0
+
 	def Flush(p):
 		"Flush all structures and folders data to disk"
 		if not p.ch or not p.ch[-1].Folders:
-			raise 'CabArcException', "You CAN'T flush a Cabinet without headers, folders or files!"
+			raise CabArcException("You CAN'T flush a Cabinet without headers, folders or files!")
+		p._pushstored()
+		if p.base or p.autotune or p.budget or p.cache or p.folderworkers:
+			p.IO.unpack() # the passes below work on CFFILE
+		if p.base:
+			p._reuse()
+		if p.autotune or p.budget:
+			p._autotune()
+		if p.cache:
+			p._cached()
+		if p.folderworkers:
+			p._pooled()
+		Q = p.IO._files
+		while Q and not isinstance(Q[-1], (CFFILE, bytes, FolderCopy)):
+			Q.pop() # a new folder with nothing to hold
+		for o in Q:
+			if isinstance(o, bytes): # a packed CFFILE
+				p.IO.total[0] += 1
+				p.IO.total[1] += CFFILE.S.unpack_from(o)[0]
+				continue
+			for f in isinstance(o, FolderCopy) and o.files or isinstance(o, CFFILE) and [o] or []:
+				p.IO.total[0] += 1
+				p.IO.total[1] += f.cbFile
 		p.IO.flush(1)
 		p.ch[-1].flags ^= 0x2
-		p.ch[-1].cbCabinet = p.IO.fout[-1].tell() + p.ch[-1].size()
-		p.IO.fout[-1].seek(0)
 		p.IO._copycab(1)
 
 	def Close(p):
+		if p.IO:
+			p.IO.close()
 		p.IO = 0
+		for h in p.ch:
+			if h.fp:
+				h.fp.close()
+				h.fp = 0
+
+	def Report(p, fmt='json'):
+		"Returns the metrics of Flush, with totals, as JSON or Prometheus text (fmt='prometheus')"
+		totals = {}
+		if p.IO:
+			totals = dict(zip(('bytes_read', 'bytes_written', 'files_written', 'cabinets'), p.Stats()[:4]))
+		if p.cache:
+			totals.update(zip(('cache_hits', 'cache_misses', 'cache_stores', 'cache_evictions'), p.cache.Stats()))
+		return p.metrics.Dump(fmt, totals)
 
 	def Stats(p):
 		"Returns a tuple with total bytes read and written, files opened, cabinets written and compression ratio"
@@ -782,20 +3460,128 @@ class Cabinet:
 
 
 
+def cmdlist(args):
+	"Lists the items of a cabinet (or set) with their size, date, time and attributes, returning the exit code"
+	if not args:
+		print('Few arguments! Use -h switch to learn more...')
+		return -3
+	try:
+		cab = Cabinet(args[0], 'r')
+	except (CabArcException, IOError, struct.error) as e:
+		print('%s: %s' % (args[0], e))
+		return -5
+	L = []
+	for x in cab.files:
+		d, t = x.date, x.time
+		L += ['%14s  %04d-%02d-%02d %02d:%02d:%02d  %s  %s' % (fmtn(x.cbFile), 1980 + (d >> 9), d >> 5 & 0xF, d & 0x1F,
+		t >> 11, t >> 5 & 0x3F, (t & 0x1F) << 1, ''.join([x.attrs & k and c or '-' for k, c in ((1, 'R'), (2, 'H'), (4, 'S'), (0x20, 'A'))]), x.text())]
+	L += ['\n%d file(s), %s bytes, in %d folder(s) of %d cabinet(s).' % (len(cab.files), fmtn(sum([x.cbFile for x in cab.files])), len(cab.folders), len(cab.ch))]
+	cab.Close()
+	print('\n'.join(L))
+	return 0
+
+
+def cmdunpack(mode, args, workers=0):
+	"Extracts (mode 'x') a cabinet or set, or tests (mode 't') many, returning the exit code"
+	if not args:
+		print('Few arguments! Use -h switch to learn more...')
+		return -3
+	StartTime = dt.now()
+	if mode == 'x':
+		try:
+			cab = Cabinet(args[0], 'r')
+		except (CabArcException, IOError, struct.error) as e:
+			print('%s: %s' % (args[0], e))
+			return -5
+		try:
+			cab.extractall(len(args) > 1 and args[1] or '', workers)
+		except (CabArcException, zlib.error, IOError, struct.error) as e:
+			print('%s: %s' % (args[0], e))
+			return -5
+		finally:
+			cab.Close()
+		print('\n%d file(s) extracted in %d seconds.' % (len(cab.files), (dt.now()-StartTime).seconds))
+		return 0
+	names = []
+	for arg in args:
+		names += sorted(glob.glob(os.path.expandvars(arg))) or [arg]
+	bad, tested, seen = 0, 0, set()
+	for name in names:
+		if os.path.abspath(name) in seen:
+			continue # tested with the set it belongs to
+		try:
+			cab = Cabinet(name, 'r')
+		except (CabArcException, IOError, struct.error) as e:
+			print('%s: %s' % (name, e))
+			bad += 1
+			continue
+		if cab.ch[0].flags & 0x1:
+			print('%s: skipped, it continues %s' % (name, fstext(cab.ch[0].szCabinetPrev.rstrip(b'\x00'))))
+			cab.Close()
+			continue
+		seen.update([os.path.abspath(h.fp.name) for h in cab.ch])
+		L = cab.testall(workers)
+		cab.Close()
+		tested += 1
+		print('%s: %s' % (name, L and 'FAILED' or 'OK'))
+		for e in L:
+			print('  ' + e)
+		bad += L and 1 or 0
+	print('\n%d cabinet(s) tested, %d failed, in %d seconds.' % (tested, bad, (dt.now()-StartTime).seconds))
+	return bad and -5 or 0
+
+
 def cmdparse():
-	print "PyCabArc.py - Version "+VERSION+"\n"+COPYRIGHT+"\n"
-	strip, comp, limit, res, rec, label = '', 9, 2**32, 0, 0, ''
-	opts, args = getopt.getopt(sys.argv[1:], 'Dd:hi:l:m:P:rs:')
+	print("PyCabArc.py - Version "+VERSION+"\n"+COPYRIGHT+"\n")
+	strip, comp, limit, res, rec, label, workers = '', 9, 2**32, 0, 0, '', 1
+	depth, readahead, strategy, route, fsize, fcount, update, repack, dedup = 0, 0, 'strict', 0, 0, 0, 0, 0, 0
+	cache, metrics, fworkers, tune, unpack, xworkers = '', '', 0, '', '', 0
+	opts, args = getopt.getopt(sys.argv[1:], 'A:acDd:ef:F:hi:j:k:l:M:m:P:q:rs:tuvx')
 
 	for opt, arg in opts:
 		if opt == '-h':
-			print '''Usage: PyCabArc [options] file.cab files
+			print('''Usage: PyCabArc [options] file.cab files
+       PyCabArc -x [-j n] file.cab [dir]
+       PyCabArc -t [-j n] file.cab [file.cab ...]
+       PyCabArc -v file.cab
 
 Options:
+-v        lists the files of the cabinet (or set), with size, date, time and
+          attributes
+-x        extracts all files of the cabinet (or set) in dir (default: the
+          current one), with their dates and attributes
+-t        tests the cabinets (or sets): verifies the CFDATA checksums and
+          inflates all the folders, writing nothing
 -i file   picks a list of file to compress from 'file'
 -r        searches for files in each sub-directory, too
 -P str    strips str from item path (* = all)
--m        sets compression type [NONE|MSZIP:1..9(default)|LZX:15..21]
+-m        sets compression type [NONE|MSZIP:1..9(default)[:strategy]|LZX:15..21 (experimental)]
+          MSZIP blocks end by strategy: strict (default), sync or full
+-A n[s]   picks the MSZIP level of each folder, by a trial on its first 64 KiB,
+          to compress n MB/s (or all folders in n seconds, with the s suffix)
+-a        stores files that don't compress (judging by a sample of each one)
+          in an uncompressed folder, next to the compressed one
+-u        updates the cabinet (or set): folders whose files didn't change (in
+          name, size and date) are copied as they are, not compressed again
+-e        stores the contents of identical files once: the copies point to
+          the first one, if in the same folder (not portable: cabextract reads
+          such cabinets, libarchive and bsdtar reject them)
+-k dir[:n] keeps compressed folders in a cache directory (up to n bytes, 1 GiB
+          by default): a folder with the same files, compressed the same way,
+          is copied from there when building again
+-M file   saves time and bytes of each stage, file and folder in file: as JSON if
+          its name ends with .json, else in Prometheus text format
+-c        copies the folders of the cabinets (or sets) given as files, as they
+          are: splits a set again with -d, or merges sets in a cabinet
+-f n[:m]  starts a new folder when files in it exceed n bytes (0 = no limit)
+          or m files: smaller folders extract a single file faster, bigger
+          ones compress better
+-j n      compresses MSZIP blocks with n threads (0 = one per CPU); with -x
+          and -t, inflates n folders at a time (default: one per CPU)
+-F n      compresses up to n MSZIP folders at a time (0 = one per CPU), each
+          one while the folders before it are written: see -f
+-q n[:m]  reads, compresses and writes in a pipeline, with n blocks queued to
+          be compressed and written, and m chunks read ahead (default 4*n)
 -s n      reserves n bytes in the cabinet header (max 60,000)
 -d size   limits each cabinet unit in a set to size (at least 50,000 bytes)
           (use # in cabinet name to replace with progressive index)
@@ -808,7 +3594,8 @@ directory names in recursive mode can not.
 Use a plus sign (+) as file name to force adding a new folder.
 	
 MSZIP compression level can be set between 1 and 9 (default).
-LZX dictionary size can be set between 15 (32 KiB) and 21 (2 MiB).'''
+LZX dictionary size can be set between 15 (32 KiB) and 21 (2 MiB): LZX is
+experimental and very slow, unless the optional _lzx module is built.''')
 			sys.exit(-1)
 
 		def parse_complevel(s):
@@ -826,16 +3613,21 @@ LZX dictionary size can be set between 15 (32 KiB) and 21 (2 MiB).'''
 			elif 'mszip' in arg:
 				comp = parse_complevel(arg) or 6
 				if comp < 1 or comp > 9:
-					print "Bad compression level for MSZIP: MUST be in the range 1...9!"
+					print("Bad compression level for MSZIP: MUST be in the range 1...9!")
+					sys.exit(-2)
+				if arg.count(':') > 1:
+					strategy = arg.split(':')[2]
+				if strategy not in MSZIP.STRATEGIES:
+					print("Bad MSZIP strategy: MUST be one of %s!" % ', '.join(MSZIP.STRATEGIES))
 					sys.exit(-2)
 			elif 'lzx' in arg:
 				comp = parse_complevel(arg) or 15
 				if comp < 15 or comp > 21:
-					print "Bad compression level for LZX: MUST be in the range 15...21!"
+					print("Bad compression level for LZX: MUST be in the range 15...21!")
 					sys.exit(-2)
 				comp = 3 | (comp << 8)
 			else:
-				print "Bad compression method with -m!"
+				print("Bad compression method with -m!")
 				sys.exit(-2)
 		if opt == '-d':	limit = int(arg)
 		if opt == '-D':
@@ -843,49 +3635,106 @@ LZX dictionary size can be set between 15 (32 KiB) and 21 (2 MiB).'''
 		if opt == '-s':	res = int(arg)
 		if opt == '-r':	rec = 1
 		if opt == '-l':	label = arg
+		if opt == '-j':	workers = xworkers = int(arg)
+		if opt == '-x':	unpack = 'x'
+		if opt == '-t':	unpack = 't'
+		if opt == '-v':	unpack = 'v'
+		if opt == '-a':	route = 1
+		if opt == '-u':	update = 1
+		if opt == '-c':	repack = 1
+		if opt == '-e':	dedup = 1
+		if opt == '-k':	cache = arg
+		if opt == '-M':	metrics = arg
+		if opt == '-A':	tune = arg
+		if opt == '-F':	fworkers = int(arg) or cpu_count()
+		if opt == '-f':
+			fsize = int(arg.split(':')[0])
+			fcount = parse_complevel(arg)
+		if opt == '-q':
+			depth = int(arg.split(':')[0])
+			readahead = parse_complevel(arg)
 		if opt == '-i':
-			print 'Reading files list from', arg
-			for li in file(arg).readlines():
+			print('Reading files list from', arg)
+			for li in open(arg).readlines():
 				args += [li[:-1]]
+
+	if unpack == 'v':
+		sys.exit(cmdlist(args))
+	if unpack:
+		sys.exit(cmdunpack(unpack, args, xworkers))
 		
 	if len(args) < 2:
-		print 'Few arguments! Use -h switch to learn more...'
+		print('Few arguments! Use -h switch to learn more...')
 		sys.exit(-3)
 
 	if res > 60000:
-		print "You can't reserve more than 60,000 bytes in CAB header!"
+		print("You can't reserve more than 60,000 bytes in CAB header!")
 		sys.exit(-4)
 
 	StartTime = dt.now()
 	
-	cab = Cabinet(args[0], 'w', limit, comp)
+	cab = Cabinet(args[0], 'w', limit, comp, workers, depth, readahead, strategy)
 	cab.label = label
 	cab.reserved = res
+	cab.route = route
+	cab.dedup = dedup
+	if cache:
+		size = 1<<30
+		if ':' in cache and cache.rsplit(':',1)[1].isdigit():
+			cache, size = cache.rsplit(':',1)
+		cab.cache = FolderCache(cache, int(size))
+	cab.foldersize = fsize
+	cab.folderfiles = fcount
+	cab.folderworkers = fworkers
+	if metrics:
+		cab.metrics = Metrics()
+	if tune.endswith('s'):
+		cab.budget = float(tune[:-1])
+	elif tune:
+		cab.autotune = float(tune)
+
+	tmp = ''
+	name = args[0].replace('#','1')
+	if update and os.path.exists(name):
+		# the cabinet (set) to update is moved aside, since it gets overwritten
+		old = Cabinet(name, 'r')
+		names = [h.fp.name for h in old.ch]
+		old.Close()
+		tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(name)))
+		for o in names:
+			os.rename(o, os.path.join(tmp, os.path.basename(o)))
+		cab.base = Cabinet(os.path.join(tmp, os.path.basename(name)), 'r')
 
 	cab.AddHeader()
 	cab.AddFolder(comp)
 
-	print "Please wait! Scanning files to add....."
+	print("Please wait! Scanning files to add.....")
 	
-	if not rec:
+	sources = []
+	if repack:
+		for arg in args[1:]:
+			sources += [Cabinet(os.path.expandvars(arg), 'r')]
+			cab.AddCabinet(sources[-1])
+	elif not rec:
 		for arg in args[1:]:
 			arg = os.path.expandvars(arg)
 			if os.path.isdir(arg):
 				arg = os.path.join(arg, '*')
 			cab.AddWild(arg,strip)
 	else:
-		from os.path import join
 		for arg in args[1:]:
-			arg = os.path.expandvars(arg)
-			for root, dirs, files in os.walk(arg, topdown=False):
-				for name in files:
-					cab.Add(join(root, name),strip)
+			cab.AddTree(os.path.expandvars(arg),strip)
 
-	if not cab.idict:
-		print "No files to add. Exiting..."
+	if not cab.added:
+		print("No files to add. Exiting...")
 		sys.exit(-4)
 		
 	cab.Flush()
+	for o in sources:
+		o.Close()
+	if tmp:
+		cab.base.Close()
+		shutil.rmtree(tmp)
 
 	StopTime = dt.now()
 	secs = (StopTime-StartTime).seconds
@@ -893,14 +3742,21 @@ LZX dictionary size can be set between 15 (32 KiB) and 21 (2 MiB).'''
 	x = cab.IO
 	y = (cab.Index - 1) * limit + cab.ch[-1].cbCabinet
 
-	print '''
+	print('''
 
 Statistics:
 -----------
 %s bytes read from %s file(s);
 %s (%s) bytes emitted in %d cabinet(s).
 Ratio: %f:1. %d seconds elapsed, speed %f KiB/s.
-''' % ( fmtn(x.c1), fmtn(x.c3), fmtn(x.c2), fmtn(y), cab.Index, float(x.c2)/(float(x.c1) or 1), secs, x.c1/1024.0/(secs or 1) )
+''' % ( fmtn(x.c1), fmtn(x.c3), fmtn(x.c2), fmtn(y), cab.Index, float(x.c2)/(float(x.c1) or 1), secs, x.c1/1024.0/(secs or 1) ))
+	if cab.cache:
+		print('Folder cache: %d hits, %d misses, %d stored, %d evicted.' % cab.cache.Stats())
+	if metrics:
+		f = open(metrics, 'w')
+		f.write(cab.Report(metrics.lower().endswith('.json') and 'json' or 'prometheus'))
+		f.close()
+		print('Metrics saved in', metrics)
 
 	cab.Close()
 
@@ -1,12 +1,13 @@
+#define PY_SSIZE_T_CLEAN
 #include "Python.h"
 
 // compute the checksum for the cabinet's CFDATA datablock
-unsigned long int checksum(unsigned char *in, unsigned short int ncbytes, unsigned long int seed)
+unsigned int checksum(const unsigned char *in, Py_ssize_t ncbytes, unsigned int seed)
 {
-	int no_ulongs;
-	unsigned long int csum=0;
-	unsigned char *stroom;
-	unsigned long int temp;
+	Py_ssize_t no_ulongs;
+	unsigned int csum=0;
+	const unsigned char *stroom;
+	unsigned int temp;
 
 	no_ulongs = ncbytes / 4;
 	csum = seed;
@@ -14,10 +15,10 @@ unsigned long int checksum(unsigned char *in, unsigned short int ncbytes, unsign
 
 	while(no_ulongs-->0)
 	{
-		temp = ((unsigned long int) (*stroom++));
-		temp |= (((unsigned long int) (*stroom++)) << 8);
-		temp |= (((unsigned long int) (*stroom++)) << 16);
-		temp |= (((unsigned long int) (*stroom++)) << 24);
+		temp = ((unsigned int) (*stroom++));
+		temp |= (((unsigned int) (*stroom++)) << 8);
+		temp |= (((unsigned int) (*stroom++)) << 16);
+		temp |= (((unsigned int) (*stroom++)) << 24);
 
 		csum ^= temp;
 	}
@@ -25,41 +26,91 @@ unsigned long int checksum(unsigned char *in, unsigned short int ncbytes, unsign
 	temp = 0;
 	switch(ncbytes%4)
 	{
-		case 3: temp |= (((unsigned long int) (*stroom++)) << 16);
-		case 2: temp |= (((unsigned long int) (*stroom++)) << 8);
-		case 1: temp |= ((unsigned long int) (*stroom++));
+		case 3: temp |= (((unsigned int) (*stroom++)) << 16);
+		case 2: temp |= (((unsigned int) (*stroom++)) << 8);
+		case 1: temp |= ((unsigned int) (*stroom++));
 		default: break;
 	}
-	
+
 	csum ^= temp;
 
-	return csum;	
+	return csum;
 }
 
 
 static PyObject *
-p_checksum(self, args)
-        PyObject *self, *args;
+p_checksum(PyObject *self, PyObject *args)
 {
  PyObject *o;
- char *s;
- unsigned int size, seed = 0;
+ Py_buffer view;
+ unsigned int csum, seed = 0;
+
+ if (!PyArg_ParseTuple(args,"O|I",&o,&seed)) return 0;
+ if (PyObject_GetBuffer(o, &view, PyBUF_SIMPLE) < 0) return 0;
 
- if (!PyArg_ParseTuple(args,"s#|I",&s,&size,&seed)) return 0;
+ Py_BEGIN_ALLOW_THREADS
+ csum = checksum(view.buf, view.len, seed);
+ Py_END_ALLOW_THREADS
+ PyBuffer_Release(&view);
 
- return Py_BuildValue("I", checksum(s,size,seed));
+ return Py_BuildValue("I", csum);
+}
+
+
+static PyObject *
+p_checksums(PyObject *self, PyObject *args)
+{
+ PyObject *o, *seq, *res, *item;
+ Py_buffer view;
+ Py_ssize_t i, n;
+ unsigned int seed = 0;
+
+ if (!PyArg_ParseTuple(args,"O|I",&o,&seed)) return 0;
+ if (!(seq = PySequence_Fast(o, "checksums() wants a sequence of blocks"))) return 0;
+ n = PySequence_Fast_GET_SIZE(seq);
+ if (!(res = PyList_New(n))) { Py_DECREF(seq); return 0; }
+
+ for (i = 0; i < n; i++)
+ {
+  if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, i), &view, PyBUF_SIMPLE) < 0)
+   goto fail;
+  item = Py_BuildValue("I", checksum(view.buf, view.len, seed));
+  PyBuffer_Release(&view);
+  if (!item) goto fail;
+  PyList_SET_ITEM(res, i, item);
+ }
+ Py_DECREF(seq);
+ return res;
+
+fail:
+ Py_DECREF(seq);
+ Py_DECREF(res);
+ return 0;
 }
 
 
 static PyMethodDef checksum_methods[] =
 {
  {"checksum", p_checksum, METH_VARARGS, "checksum(s, seed)"},
+ {"checksums", p_checksums, METH_VARARGS, "checksums(blocks, seed) -> list"},
  {NULL, NULL, 0, NULL}
 };
 
-__declspec(dllexport)
-void
-init_checksum()
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef checksum_module =
+{
+ PyModuleDef_HEAD_INIT, "_checksum", NULL, -1, checksum_methods
+};
+
+PyMODINIT_FUNC
+PyInit__checksum(void)
+{
+ return PyModule_Create(&checksum_module);
+}
+#else
+PyMODINIT_FUNC
+init_checksum(void)
 {
  Py_InitModule("_checksum", checksum_methods);
 }
+#endif
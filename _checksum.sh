@@ -0,0 +1,9 @@
+#!/bin/sh
+# builds the _checksum module with cc (or $CC) for python (or $PYTHON)
+PYTHON=${PYTHON:-python}
+CC=${CC:-cc}
+INC=`$PYTHON -c "import sysconfig; print(sysconfig.get_paths()['include'])"`
+EXT=`$PYTHON -c "import sysconfig; print(sysconfig.get_config_var('EXT_SUFFIX') or '.so')"`
+LDFLAGS="-shared"
+if [ `uname` = Darwin ]; then LDFLAGS="-bundle -undefined dynamic_lookup"; fi
+$CC -O2 -fPIC -I"$INC" $LDFLAGS _checksum.c -o _checksum$EXT
@@ -0,0 +1,5 @@
+@echo off
+cl -nologo -MD -Oxb2 -LD -IC:/Python27/include _lzx.c C:/Python27/libs/python27.lib user32.lib /link /out:_lzx.pyd
+del _lzx.obj
+del _lzx.exp
+del _lzx.lib
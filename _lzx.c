@@ -0,0 +1,508 @@
+#define PY_SSIZE_T_CLEAN
+#include "Python.h"
+#include <stdlib.h>
+#include <string.h>
+
+// PyLZX's match finder and bit writer, which give the same blocks as the Python
+// ones (PyLZX._parse, _counts and _write) many times faster
+
+// footer bits and first formatted offset of each position slot (LZX_EXTRA, LZX_BASE)
+static int extra_bits[52];
+static long position_base[51];
+
+static void init_slots(void)
+{
+	int i;
+	for (i = 0; i < 52; i++)
+		extra_bits[i] = i < 2 ? 0 : ((i - 2) >> 1 < 17 ? (i - 2) >> 1 : 17);
+	position_base[0] = 0;
+	for (i = 1; i < 51; i++)
+		position_base[i] = position_base[i-1] + (1L << extra_bits[i-1]);
+}
+
+static int position_slot(long f)
+{
+	int a = 0, b = 51;
+	// bisect_right(LZX_BASE, f) - 1
+	while (a < b)
+	{
+		int m = (a + b) >> 1;
+		if (f < position_base[m]) b = m; else a = m + 1;
+	}
+	return a - 1;
+}
+
+#if PY_MAJOR_VERSION >= 3
+static int get_wbuffer(PyObject *o, Py_buffer *view)
+{
+	return PyObject_GetBuffer(o, view, PyBUF_WRITABLE);
+}
+#define release_wbuffer PyBuffer_Release
+#else
+// array.array has only the old buffer interface, with Python 2
+static int get_wbuffer(PyObject *o, Py_buffer *view)
+{
+	void *buf;
+	Py_ssize_t len;
+	if (PyObject_AsWriteBuffer(o, &buf, &len) < 0) return -1;
+	view->buf = buf;
+	view->len = len;
+	return 0;
+}
+static void release_wbuffer(Py_buffer *view) {}
+#endif
+
+
+
+// match finder: hash chains of the positions of each 4 bytes sequence
+
+typedef struct
+{
+	const unsigned char *W;
+	Py_ssize_t end, base, maxoff;
+	int *head, *prev;
+	long mask;
+} finder;
+
+static unsigned int hash4(const unsigned char *s)
+{
+	unsigned long long v = (unsigned int) s[0] | (unsigned int) s[1] << 8 | (unsigned int) s[2] << 16 | (unsigned int) s[3] << 24;
+	return (unsigned int) (v * 2654435761ULL >> 16) & 0xFFFF;
+}
+
+static int common(const unsigned char *a, const unsigned char *b, int n)
+{
+	int l = 0;
+	while (l < n && a[l] == b[l]) l++;
+	return l;
+}
+
+// walks the chain of positions with the same hash, nearest first
+static int longest(finder *F, Py_ssize_t i, long cand, int best, int d, Py_ssize_t *off)
+{
+	const unsigned char *W = F->W;
+	Py_ssize_t j, n = F->end - i;
+	long x;
+	if (n > 257) n = 257;
+	*off = 0;
+	if (best >= n) return best;
+	while (cand >= 0 && d)
+	{
+		j = cand - F->base;
+		if (j < 0 || i - j > F->maxoff) break;
+		if (W[j+best] == W[i+best] && !memcmp(W + j, W + i, 4))
+		{
+			int l = 4 + common(W + j + 4, W + i + 4, (int) n - 4);
+			if (l > best)
+			{
+				best = l;
+				*off = i - j;
+				if (l >= n) break;
+			}
+		}
+		x = F->prev[cand & F->mask];
+		if (x >= cand) break; // overwritten by a newer position
+		cand = x;
+		d--;
+	}
+	return best;
+}
+
+static void insert(finder *F, Py_ssize_t k)
+{
+	unsigned int h = hash4(F->W + k);
+	F->prev[(F->base + k) & F->mask] = F->head[h];
+	F->head[h] = (int) (F->base + k);
+}
+
+// tokens: a literal run W[-a-1:-a-1+b] or a match (formatted offset a, length b)
+static Py_ssize_t parse(finder *F, Py_ssize_t i, long R[3], int depth, Py_ssize_t *T)
+{
+	const unsigned char *W = F->W;
+	Py_ssize_t end = F->end, last = end - 3, lit = i, miss = i, nt = 0;
+	Py_ssize_t j, n, off, noff, f, k, r;
+	int best, rlen, rk, l;
+	long cand, t;
+
+	while (i < last)
+	{
+		unsigned int h = hash4(W + i);
+		cand = F->head[h];
+		F->head[h] = (int) (F->base + i);
+		F->prev[(F->base + i) & F->mask] = (int) cand;
+		n = end - i;
+		if (n > 257) n = 257;
+		// repeated offsets cost no footer: they are tried first
+		rlen = rk = 0;
+		for (k = 0; k < 3; k++)
+		{
+			j = i - R[k];
+			if (j >= 0 && W[j] == W[i] && W[j+1] == W[i+1])
+			{
+				l = 2 + common(W + j + 2, W + i + 2, (int) n - 2);
+				if (l > rlen) { rlen = l; rk = (int) k; }
+			}
+		}
+		best = longest(F, i, cand, 3, depth, &off);
+		if (rlen >= 2 && (!off || rlen + 1 >= best))
+		{
+			best = rlen;
+			f = rk;
+			if (rk) { t = R[0]; R[0] = R[rk]; R[rk] = t; }
+		}
+		else if (off)
+		{
+			// lazy evaluation: a literal, if a longer match starts next
+			if (i + 1 < last)
+			{
+				longest(F, i + 1, F->head[hash4(W + i + 1)], best + 1, depth, &noff);
+				if (noff) { i++; continue; }
+			}
+			f = off + 2;
+			R[2] = R[1]; R[1] = R[0]; R[0] = (long) off;
+		}
+		else
+		{
+			// where nothing matched for a while, positions are skipped
+			i += 1 + ((i - miss) >> 7);
+			continue;
+		}
+		if (lit < i)
+		{
+			T[nt++] = -lit - 1;
+			T[nt++] = i - lit;
+		}
+		T[nt++] = f;
+		T[nt++] = best;
+		r = i + best < last ? i + best : last;
+		for (k = i + 1; k < r; k++)
+			insert(F, k);
+		i += best;
+		lit = miss = i;
+	}
+	if (lit < end)
+	{
+		T[nt++] = -lit - 1;
+		T[nt++] = end - lit;
+	}
+	return nt;
+}
+
+static PyObject *
+p_parse(PyObject *self, PyObject *args)
+{
+	PyObject *o, *oh, *op, *res = 0, *L = 0, *item;
+	Py_buffer view, hv, pv;
+	Py_ssize_t i, end, base, nt, k, *T;
+	long R[3];
+	int depth;
+	finder F;
+
+	if (!PyArg_ParseTuple(args, "Onnn(lll)OOi", &o, &i, &end, &base, &R[0], &R[1], &R[2], &oh, &op, &depth)) return 0;
+	if (PyObject_GetBuffer(o, &view, PyBUF_SIMPLE) < 0) return 0;
+	if (get_wbuffer(oh, &hv) < 0) { PyBuffer_Release(&view); return 0; }
+	if (get_wbuffer(op, &pv) < 0) { release_wbuffer(&hv); PyBuffer_Release(&view); return 0; }
+	if (i < 0 || end > view.len || i > end || hv.len < 65536 * (Py_ssize_t) sizeof(int) || pv.len < (Py_ssize_t) sizeof(int))
+	{
+		PyErr_SetString(PyExc_ValueError, "parse() wants a window, a 64K head and a prev array");
+		goto done;
+	}
+	if (!(T = (Py_ssize_t *) malloc(sizeof(Py_ssize_t) * 4 * (end - i + 1))))
+	{
+		PyErr_NoMemory();
+		goto done;
+	}
+	F.W = (const unsigned char *) view.buf;
+	F.end = end;
+	F.base = base;
+	F.head = (int *) hv.buf;
+	F.prev = (int *) pv.buf;
+	F.mask = (long) (pv.len / sizeof(int)) - 1;
+	F.maxoff = F.mask - 2;
+
+	Py_BEGIN_ALLOW_THREADS
+	nt = parse(&F, i, R, depth, T);
+	Py_END_ALLOW_THREADS
+
+	if (!(L = PyList_New(nt >> 1))) goto fail;
+	for (k = 0; k < nt; k += 2)
+	{
+		if (T[k] < 0)
+			item = PyBytes_FromStringAndSize((const char *) F.W - T[k] - 1, T[k+1]);
+		else
+			item = Py_BuildValue("(nn)", T[k], T[k+1]);
+		if (!item) goto fail;
+		PyList_SET_ITEM(L, k >> 1, item);
+	}
+	res = Py_BuildValue("(N(lll))", L, R[0], R[1], R[2]);
+	L = 0;
+fail:
+	Py_XDECREF(L);
+	free(T);
+done:
+	release_wbuffer(&pv);
+	release_wbuffer(&hv);
+	PyBuffer_Release(&view);
+	return res;
+}
+
+
+
+// symbol frequencies of the tokens: main tree, length tree and aligned offsets
+
+static PyObject *to_list(unsigned long *c, Py_ssize_t n)
+{
+	PyObject *L = PyList_New(n), *x;
+	Py_ssize_t i;
+	if (!L) return 0;
+	for (i = 0; i < n; i++)
+	{
+		if (!(x = PyLong_FromUnsignedLong(c[i]))) { Py_DECREF(L); return 0; }
+		PyList_SET_ITEM(L, i, x);
+	}
+	return L;
+}
+
+// the main tree symbol, length tree symbol (-1 if none), footer bits and footer of a match
+static int match_symbols(PyObject *t, Py_ssize_t nmain, Py_ssize_t *m, Py_ssize_t *y, int *x, long *footer)
+{
+	Py_ssize_t f, l;
+	int slot;
+	if (!PyArg_ParseTuple(t, "nn", &f, &l)) return -1;
+	slot = position_slot((long) f);
+	if (f < 0 || l < 2 || l > 257 || 256 + (slot << 3) + 7 >= nmain)
+	{
+		PyErr_SetString(PyExc_ValueError, "bad LZX match");
+		return -1;
+	}
+	*m = 256 + (slot << 3) + (l - 2 < 7 ? l - 2 : 7);
+	*y = l - 2 < 7 ? -1 : l - 9;
+	*x = extra_bits[slot];
+	*footer = (long) f - position_base[slot];
+	return 0;
+}
+
+static PyObject *
+p_counts(PyObject *self, PyObject *args)
+{
+	PyObject *o, *seq, *t, *res = 0, *a = 0, *b = 0, *c = 0;
+	Py_buffer view;
+	Py_ssize_t n, i, k, nmain, m, y;
+	unsigned long *fm, fl[249], fa[8];
+	long footer;
+	int x;
+
+	if (!PyArg_ParseTuple(args, "On", &o, &nmain)) return 0;
+	if (nmain < 256 || nmain > 256 + 8 * 50)
+	{
+		PyErr_SetString(PyExc_ValueError, "bad LZX main tree size");
+		return 0;
+	}
+	if (!(seq = PySequence_Fast(o, "counts() wants a sequence of tokens"))) return 0;
+	if (!(fm = (unsigned long *) calloc(nmain, sizeof(unsigned long)))) { Py_DECREF(seq); return PyErr_NoMemory(); }
+	memset(fl, 0, sizeof(fl));
+	memset(fa, 0, sizeof(fa));
+	n = PySequence_Fast_GET_SIZE(seq);
+	for (i = 0; i < n; i++)
+	{
+		t = PySequence_Fast_GET_ITEM(seq, i);
+		if (PyTuple_Check(t))
+		{
+			if (match_symbols(t, nmain, &m, &y, &x, &footer) < 0) goto fail;
+			fm[m]++;
+			if (y >= 0) fl[y]++;
+			if (x >= 3) fa[footer & 7]++;
+			continue;
+		}
+		if (PyObject_GetBuffer(t, &view, PyBUF_SIMPLE) < 0) goto fail;
+		for (k = 0; k < view.len; k++)
+			fm[((unsigned char *) view.buf)[k]]++;
+		PyBuffer_Release(&view);
+	}
+	if ((a = to_list(fm, nmain)) && (b = to_list(fl, 249)) && (c = to_list(fa, 8)))
+		res = Py_BuildValue("(OOO)", a, b, c);
+	Py_XDECREF(a);
+	Py_XDECREF(b);
+	Py_XDECREF(c);
+fail:
+	free(fm);
+	Py_DECREF(seq);
+	return res;
+}
+
+
+
+// bit writer: bits are packed from the most significant in 16-bit little endian words
+
+typedef struct
+{
+	unsigned char *buf;
+	Py_ssize_t len, size;
+	unsigned long long acc;
+	int n;
+} bitwriter;
+
+static int put(bitwriter *B, unsigned long v, int n)
+{
+	B->acc = B->acc << n | v;
+	B->n += n;
+	while (B->n >= 16)
+	{
+		unsigned int w;
+		if (B->len + 2 > B->size)
+		{
+			unsigned char *s = (unsigned char *) realloc(B->buf, B->size * 2 + 64);
+			if (!s) return -1;
+			B->buf = s;
+			B->size = B->size * 2 + 64;
+		}
+		B->n -= 16;
+		w = (unsigned int) (B->acc >> B->n) & 0xFFFF;
+		B->buf[B->len++] = w & 0xFF;
+		B->buf[B->len++] = w >> 8;
+	}
+	B->acc &= (1ULL << B->n) - 1;
+	return 0;
+}
+
+// canonical codes of code lengths (like HuffmanCodes), from a list of them
+static int canonical(PyObject *o, Py_ssize_t n, unsigned char *lens, unsigned long *codes)
+{
+	PyObject *seq;
+	Py_ssize_t i;
+	unsigned long code = 0;
+	int l, count[18] = {0};
+
+	if (!(seq = PySequence_Fast(o, "code lengths wanted"))) return -1;
+	if (PySequence_Fast_GET_SIZE(seq) != n)
+	{
+		Py_DECREF(seq);
+		PyErr_SetString(PyExc_ValueError, "bad number of code lengths");
+		return -1;
+	}
+	for (i = 0; i < n; i++)
+	{
+		long x = PyLong_AsLong(PySequence_Fast_GET_ITEM(seq, i));
+		if (x < 0 || x > 16)
+		{
+			Py_DECREF(seq);
+			if (!PyErr_Occurred()) PyErr_SetString(PyExc_ValueError, "bad code length");
+			return -1;
+		}
+		lens[i] = (unsigned char) x;
+		count[x]++;
+	}
+	Py_DECREF(seq);
+	{
+		unsigned long next[18];
+		count[0] = 0;
+		for (l = 1; l <= 16; l++)
+		{
+			code = (code + count[l-1]) << 1;
+			next[l] = code;
+		}
+		for (i = 0; i < n; i++)
+			if (lens[i])
+				codes[i] = next[lens[i]]++;
+	}
+	return 0;
+}
+
+static PyObject *
+p_write(PyObject *self, PyObject *args)
+{
+	PyObject *o, *ml, *ll, *al, *seq, *t, *res = 0;
+	const char *prefix;
+	Py_ssize_t np, n, i, k, nmain, m, y;
+	Py_buffer view;
+	unsigned char mlens[256 + 8 * 50], llens[249], alens[8];
+	unsigned long mcodes[256 + 8 * 50], lcodes[249], acodes[8];
+	long footer;
+	int x, aligned;
+	bitwriter B;
+
+	if (!PyArg_ParseTuple(args, "s#OOOO", &prefix, &np, &o, &ml, &ll, &al)) return 0;
+	aligned = al != Py_None;
+	nmain = PySequence_Size(ml);
+	if (nmain < 256 || nmain > 256 + 8 * 50)
+	{
+		if (!PyErr_Occurred()) PyErr_SetString(PyExc_ValueError, "bad LZX main tree size");
+		return 0;
+	}
+	if (canonical(ml, nmain, mlens, mcodes) < 0 || canonical(ll, 249, llens, lcodes) < 0) return 0;
+	if (aligned && canonical(al, 8, alens, acodes) < 0) return 0;
+	if (!(seq = PySequence_Fast(o, "write() wants a sequence of tokens"))) return 0;
+	B.size = 4096;
+	B.len = B.n = 0;
+	B.acc = 0;
+	if (!(B.buf = (unsigned char *) malloc(B.size))) { Py_DECREF(seq); return PyErr_NoMemory(); }
+
+	for (i = 0; i < np; i++)
+		if (put(&B, prefix[i] == '1', 1) < 0) goto nomem;
+	n = PySequence_Fast_GET_SIZE(seq);
+	for (i = 0; i < n; i++)
+	{
+		t = PySequence_Fast_GET_ITEM(seq, i);
+		if (PyTuple_Check(t))
+		{
+			if (match_symbols(t, nmain, &m, &y, &x, &footer) < 0) goto fail;
+			if (put(&B, mcodes[m], mlens[m]) < 0) goto nomem;
+			if (y >= 0 && put(&B, lcodes[y], llens[y]) < 0) goto nomem;
+			if (aligned && x >= 3)
+			{
+				if (x > 3 && put(&B, (unsigned long) footer >> 3, x - 3) < 0) goto nomem;
+				if (put(&B, acodes[footer & 7], alens[footer & 7]) < 0) goto nomem;
+			}
+			else if (x && put(&B, (unsigned long) footer, x) < 0) goto nomem;
+			continue;
+		}
+		if (PyObject_GetBuffer(t, &view, PyBUF_SIMPLE) < 0) goto fail;
+		for (k = 0; k < view.len; k++)
+		{
+			int c = ((unsigned char *) view.buf)[k];
+			if (put(&B, mcodes[c], mlens[c]) < 0) { PyBuffer_Release(&view); goto nomem; }
+		}
+		PyBuffer_Release(&view);
+	}
+	// pads the last word
+	if (B.n && put(&B, 0, 16 - B.n) < 0) goto nomem;
+	res = PyBytes_FromStringAndSize((const char *) B.buf, B.len);
+	goto done;
+nomem:
+	PyErr_NoMemory();
+fail:
+done:
+	free(B.buf);
+	Py_DECREF(seq);
+	return res;
+}
+
+
+static PyMethodDef lzx_methods[] =
+{
+ {"parse", p_parse, METH_VARARGS, "parse(W, i, end, base, R, head, prev, depth) -> (tokens, R)"},
+ {"counts", p_counts, METH_VARARGS, "counts(tokens, nmain) -> (main, length, aligned) frequencies"},
+ {"write", p_write, METH_VARARGS, "write(bits, tokens, mlens, llens, alens or None) -> packed block"},
+ {NULL, NULL, 0, NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef lzx_module =
+{
+ PyModuleDef_HEAD_INIT, "_lzx", NULL, -1, lzx_methods
+};
+
+PyMODINIT_FUNC
+PyInit__lzx(void)
+{
+ init_slots();
+ return PyModule_Create(&lzx_module);
+}
+#else
+PyMODINIT_FUNC
+init_lzx(void)
+{
+ init_slots();
+ Py_InitModule("_lzx", lzx_methods);
+}
+#endif
@@ -0,0 +1,362 @@
+#!/usr/bin/python
+
+"""
+bench.py
+
+Benchmarks PyCabArc's cabinet writer and its hot paths on synthetic corpora,
+generated (always the same, from a fixed seed) in a work directory:
+
+	text     lorem ipsum lines
+	binary   packed records, like a table or an executable's data
+	random   incompressible bytes
+	tiny     many files of 0..512 bytes
+	huge     a few big files, made of text and binary slices
+
+Benchmarks:
+
+	mszip.L.corpus     MSZIP.compress (and flush) of 32 KiB blocks at level L
+	lzx.W.corpus       PyLZX.compress of 32 KiB blocks with a 2^W bytes window
+	                   (its match finder and bit writer in C, if _lzx is built);
+	                   the blocks are then checked with UnLZX
+	lzx.edge           LZX round trips of frames giving a single code, or the
+	                   last one, to each tree (main, length, aligned, pretree)
+	checksum.impl      CFDATA checksum of 32 KiB blocks with Checksum (python),
+	                   NumPyChecksum (numpy) or _checksum (c), if available
+	iostream.corpus    a whole cabinet (MSZIP level 6) built from the corpus
+	iostream.huge.q4   the same, pipelined with 4 blocks queued (-q 4)
+	iostream.huge.f2   the same, a folder per file, 2 compressed at a time (-F 2)
+	split.N            a cabinet set of the text corpus, in units of N bytes
+	header.write/read  serialization (and parsing) of a header with 20000 files
+
+Each one runs in its own process, so that its peak RSS can be told: results
+(MB/s of input, compression ratio, seconds, peak RSS) are printed and can be
+saved as JSON, to compare them with the ones of another commit.
+
+Usage: bench.py [-d workdir] [-s scale] [-k pattern] [-o new.json] [-c old.json]
+
+	-d dir      keeps the corpora in dir (a temporary one is removed at end)
+	-s scale    multiplies the corpora sizes (default 1.0, about 50 MB)
+	-k pattern  runs only the benchmarks matching pattern (i.e. mszip.*)
+	-o file     saves the results as JSON
+	-c file     compares the results with a JSON file saved before
+"""
+
+from __future__ import print_function
+
+import fnmatch
+import getopt
+import io
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from PyCabArc import *
+import PyCabArc
+
+try:
+	import resource
+except ImportError: # Windows
+	resource = None
+
+if sys.version_info[0] > 2:
+	xrange = range
+
+WORDS = '''lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor
+incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud
+exercitation ullamco laboris nisi aliquip ex ea commodo consequat'''.split()
+
+MB = float(1<<20)
+
+
+
+def text(rng, n):
+	"Returns about n bytes of lorem ipsum lines"
+	L, size = [], 0
+	while size < n:
+		s = ' '.join([rng.choice(WORDS) for i in xrange(rng.randint(4, 16))]).capitalize() + '.\n'
+		L += [s]
+		size += len(s)
+	return ''.join(L)[:n].encode('ascii')
+
+def binary(rng, n):
+	"Returns n bytes of packed records, with counters, flags, floats and names"
+	L = []
+	for i in xrange(n // 32 + 1):
+		L += [struct.pack('<IHHd8sQ', i, rng.randint(0, 15), i & 0xFFF0, i / 7.0, rng.choice(WORDS)[:8].encode('ascii'), i * 4096)]
+	return b''.join(L)[:n]
+
+def incompressible(rng, n):
+	"Returns n random bytes"
+	k = n // 8 + 1
+	return struct.pack('<%dQ' % k, *[rng.getrandbits(64) for i in xrange(k)])[:n]
+
+def write(name, s):
+	d = os.path.dirname(name)
+	if not os.path.isdir(d):
+		os.makedirs(d)
+	f = open(name, 'wb')
+	f.write(s)
+	f.close()
+
+def MakeCorpora(top, scale=1.0):
+	"Generates the corpora in top, if not there yet"
+	mark = os.path.join(top, 'scale.txt')
+	if os.path.exists(mark) and open(mark).read() == repr(scale):
+		return
+	rng = random.Random(1)
+	print('Generating corpora in %s...' % top)
+	n = int(scale * (1<<20))
+	for i in xrange(8):
+		write(os.path.join(top, 'text', 't%d.txt' % i), text(rng, n))
+		write(os.path.join(top, 'binary', 'b%d.dat' % i), binary(rng, n))
+	for i in xrange(4):
+		write(os.path.join(top, 'random', 'r%d.bin' % i), incompressible(rng, n))
+	for i in xrange(int(2000 * scale)):
+		write(os.path.join(top, 'tiny', 'd%02d' % (i % 20), 'f%04d.txt' % i), text(rng, rng.randint(0, 512)))
+	for i in xrange(2):
+		L = []
+		for j in xrange(16):
+			kind = ('text', 'binary')[j & 1]
+			L += [open(os.path.join(top, kind, '%s%d.%s' % (kind[0], j % 8, ('txt', 'dat')[j & 1])), 'rb').read()]
+		write(os.path.join(top, 'huge', 'h%d.dat' % i), b''.join(L))
+	write(mark, repr(scale).encode('ascii'))
+
+def sample(top, corpus, n):
+	"Returns the first n bytes of a corpus, as 32 KiB blocks"
+	L, size = [], 0
+	for name in sorted(os.listdir(os.path.join(top, corpus))):
+		L += [open(os.path.join(top, corpus, name), 'rb').read()]
+		size += len(L[-1])
+		if size >= n: break
+	s = b''.join(L)[:n]
+	return [s[i:i+32768] for i in xrange(0, len(s), 32768)]
+
+
+
+def BenchMSZIP(top, scale, level, corpus, cls=MSZIP):
+	blocks = sample(top, corpus, int(2 * scale * (1<<20)))
+	c = cls(level)
+	n, L = 0, []
+	t0 = timeit.default_timer()
+	for s in blocks:
+		L += [c.compress(s)]
+		n += len(L[-1])
+	n += len(c.flush())
+	t = timeit.default_timer() - t0
+	if cls is PyLZX:
+		d = UnLZX(level)
+		for s, x in zip(blocks, L):
+			if d.decompress(x, len(s)) != s:
+				raise CabArcException('LZX round trip failed!')
+	return sum([len(s) for s in blocks]), n, t
+
+def RoundTrip(level, stream):
+	"Compresses a stream in 32 KiB frames with PyLZX, checking that UnLZX gives them back"
+	c, d = PyLZX(level), UnLZX(level)
+	for i in xrange(0, len(stream), 32768):
+		s = stream[i:i+32768]
+		if d.decompress(c.compress(s), len(s)) != s:
+			raise CabArcException('LZX round trip failed (2^%d window, frame at %d)!' % (level, i))
+	return len(stream)
+
+def BenchLZXEdge(top, scale):
+	rng = random.Random(1)
+	t0 = timeit.default_timer()
+	n = 0
+	for level in (15, 16, 21):
+		nmain = 256 + 8 * LZX_SLOTS[level]
+		# a tree with a single code (the first or the last one) gets a sibling
+		for size, limit in ((nmain, 16), (249, 16), (8, 7), (20, 15)):
+			for k in (0, size - 1):
+				f = [0] * size
+				f[k] = 1
+				L = HuffmanLengths(f, limit)
+				if L[k] != 1 or len([x for x in L if x]) != 2:
+					raise CabArcException('Bad lengths for a single code!')
+		R = incompressible(rng, 300)
+		for stream in (b'a', # a single literal
+			b'\0' * (32768 + 263), # zero runs: a single length, the last one
+			R + incompressible(rng, 32000) + R, # a far match: the last main code
+			incompressible(rng, 1029) * 40, # one offset, the same aligned bits
+			incompressible(rng, 40000), # literals only: no length code
+			text(rng, 100000)):
+			n += RoundTrip(level, stream)
+	return n, 0, timeit.default_timer() - t0
+
+def BenchChecksum(top, scale, impl):
+	blocks = sample(top, 'random', int(4 * scale * (1<<20)))
+	f = {'python': Checksum, 'numpy': NumPyChecksum}.get(impl)
+	if impl == 'c':
+		import _checksum
+		f = _checksum.checksum
+	t0 = timeit.default_timer()
+	for s in blocks:
+		f(s)
+	return sum([len(s) for s in blocks]), 0, timeit.default_timer() - t0
+
+def BenchCabinet(top, scale, corpus, limit=2**32, depth=0, fworkers=0):
+	out = tempfile.mkdtemp()
+	try:
+		t0 = timeit.default_timer()
+		cab = Cabinet(os.path.join(out, limit < 2**32 and 'b#.cab' or 'b.cab'), 'w', limit, 6, depth=depth)
+		if fworkers:
+			cab.folderfiles = 1
+			cab.folderworkers = fworkers
+		cab.AddHeader()
+		cab.AddFolder(6)
+		cab.AddTree(os.path.join(top, corpus))
+		cab.Flush()
+		t = timeit.default_timer() - t0
+		x = cab.Stats()
+		cab.Close()
+	finally:
+		shutil.rmtree(out)
+	return x[0], x[1], t
+
+def BenchHeader(top, scale, op):
+	rng = random.Random(1)
+	h = CFHEADER()
+	for i in xrange(4):
+		F = CFFOLDER()
+		F._coffCabStart = 0
+		F.typeCompress = 1
+		h.Folders += [F]
+	for i in xrange(20000):
+		f = CFFILE()
+		f.Name = ('dir%02d\\%s%05d.%s' % (i % 50, rng.choice(WORDS), i, rng.choice(('txt', 'dll', 'inf')))).encode('ascii')
+		f.cbFile = rng.randint(0, 1<<20)
+		f.iFolder = i % 4
+		h.Folders[i % 4].Files += [f]
+	h.cbCabinet = h.size() # a cabinet of the header only
+	fp = io.BytesIO()
+	t0 = timeit.default_timer()
+	h.Write(fp)
+	t = timeit.default_timer() - t0
+	n = fp.tell()
+	if op == 'read':
+		fp.seek(0)
+		t0 = timeit.default_timer()
+		CFHEADER().Read(fp)
+		t = timeit.default_timer() - t0
+	return n, 0, t
+
+def Benchmarks():
+	"Returns the (name, function, arguments) of all the benchmarks available here"
+	L = []
+	for level in (1, 6, 9):
+		for corpus in ('text', 'binary', 'random'):
+			L += [('mszip.%d.%s' % (level, corpus), BenchMSZIP, (level, corpus))]
+	for level in (15, 21):
+		for corpus in ('text', 'binary', 'random'):
+			L += [('lzx.%d.%s' % (level, corpus), BenchMSZIP, (level, corpus, PyLZX))]
+	L += [('lzx.edge', BenchLZXEdge, ())]
+	impls = ['python']
+	if hasattr(PyCabArc, 'numpy'):
+		impls += ['numpy']
+	if hasattr(PyCabArc, '_checksum'):
+		impls += ['c']
+	for impl in impls:
+		L += [('checksum.%s' % impl, BenchChecksum, (impl,))]
+	for corpus in ('text', 'binary', 'random', 'tiny', 'huge'):
+		L += [('iostream.%s' % corpus, BenchCabinet, (corpus,))]
+	L += [('iostream.huge.q4', BenchCabinet, ('huge', 2**32, 4))]
+	L += [('iostream.huge.f2', BenchCabinet, ('huge', 2**32, 0, 2))]
+	for limit in (60000, 1440000):
+		L += [('split.%d' % limit, BenchCabinet, ('text', limit))]
+	L += [('header.write', BenchHeader, ('write',)), ('header.read', BenchHeader, ('read',))]
+	return L
+
+def PeakRSS():
+	"Returns the peak resident set size of this process, in KiB"
+	if not resource:
+		return None
+	x = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		x //= 1024 # bytes there
+	return x
+
+def Run(top, scale, name):
+	"Runs a benchmark in this process, printing its result as JSON"
+	for o, f, args in Benchmarks():
+		if o == name:
+			nin, nout, secs = f(top, scale, *args)
+			print(json.dumps({'name': name, 'mbps': round(nin / MB / (secs or 1e-9), 3),
+			'ratio': nout and round(float(nout) / nin, 4) or None, 'secs': round(secs, 4),
+			'bytes': nin, 'rss_kib': PeakRSS()}))
+			return
+	raise CabArcException('No benchmark %s!' % name)
+
+def Spawn(top, scale, name):
+	"Runs a benchmark in a new process, returning its result"
+	P = subprocess.Popen([sys.executable, os.path.abspath(__file__), '-R', name, '-d', top, '-s', repr(scale)], stdout=subprocess.PIPE)
+	s = P.communicate()[0]
+	if P.returncode:
+		return {'name': name, 'error': P.returncode}
+	return json.loads(s.strip().splitlines()[-1].decode())
+
+def Report(results, base=None):
+	B = {}
+	if base:
+		for r in base['results']:
+			B[r['name']] = r
+	print('%-20s %10s %8s %9s %9s%s' % ('benchmark', 'MB/s', 'ratio', 'secs', 'RSS KiB', base and '  vs base' or ''))
+	for r in results:
+		if 'error' in r:
+			print('%-20s failed (%d)' % (r['name'], r['error']))
+			continue
+		s = '%-20s %10.2f %8s %9.3f %9s' % (r['name'], r['mbps'], r['ratio'] and '%.4f' % r['ratio'] or '-', r['secs'], r['rss_kib'])
+		b = B.get(r['name'])
+		if b and b.get('mbps'):
+			s += '  %+7.1f%%' % ((r['mbps'] / b['mbps'] - 1) * 100)
+		print(s)
+
+
+
+def main():
+	top, scale, pattern, out, base, run = '', 1.0, '*', '', '', ''
+	opts, args = getopt.getopt(sys.argv[1:], 'c:d:hk:o:R:s:')
+	for opt, arg in opts:
+		if opt == '-h':
+			print(__doc__)
+			sys.exit(0)
+		if opt == '-c': base = arg
+		if opt == '-d': top = arg
+		if opt == '-k': pattern = arg
+		if opt == '-o': out = arg
+		if opt == '-R': run = arg
+		if opt == '-s': scale = float(arg)
+
+	if run:
+		return Run(top, scale, run)
+
+	tmp = not top
+	if tmp:
+		top = tempfile.mkdtemp()
+	try:
+		MakeCorpora(top, scale)
+		results = []
+		for name, f, args in Benchmarks():
+			if fnmatch.fnmatch(name, pattern):
+				results += [Spawn(top, scale, name)]
+	finally:
+		if tmp:
+			shutil.rmtree(top)
+
+	doc = {'version': VERSION, 'python': sys.version.split()[0], 'platform': sys.platform,
+	'scale': scale, 'results': results}
+	Report(results, base and json.load(open(base)))
+	if out:
+		json.dump(doc, open(out, 'w'), indent=1)
+		print('Results saved in', out)
+
+
+
+if __name__ == '__main__':
+	main()